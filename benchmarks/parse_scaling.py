@@ -0,0 +1,49 @@
+__author__ = 'Nikita Denissov'
+
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from notateit_viewer.parser import PNG_SIGNATURE, parse_page_simple
+
+
+def make_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def make_png(payload_size: int) -> bytes:
+    ihdr = struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)
+    payload = bytes(i * 7 % 251 + 1 for i in range(payload_size))
+    return PNG_SIGNATURE + make_chunk(b'IHDR', ihdr) + make_chunk(b'IDAT', payload) + make_chunk(b'IEND', b'')
+
+
+def make_text(value: str) -> bytes:
+    encoded = value.encode()
+    return struct.pack('<I', len(encoded)) + encoded + b'<\0'
+
+
+def make_page(images: int, png: bytes) -> bytes:
+    return make_text("Title") + b'\0'.join([png] * images) + b'\0' + make_text("Footer")
+
+
+def main():
+    png = make_png(64 * 1024)
+    print(f"{'images':>8} {'page MB':>8} {'seconds':>8} {'MB/s':>8}")
+    with tempfile.TemporaryDirectory() as assets_dir:
+        for images in (25, 50, 100, 200, 400):
+            page = make_page(images, png)
+            started = time.perf_counter()
+            objects = parse_page_simple(page, 1, Path(assets_dir))
+            elapsed = time.perf_counter() - started
+            assert len(objects) == images + 2
+            size_mb = len(page) / 2 ** 20
+            print(f"{images:>8} {size_mb:>8.1f} {elapsed:>8.3f} {size_mb / elapsed:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,35 +4,59 @@ import sys
 from argparse import ArgumentParser
 from pathlib import Path
 
-from PIL import Image
 from PySide6.QtCore import Qt
 from PySide6.QtGui import QAction, QKeySequence, QIcon
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QLabel, QFileDialog, QScrollArea, QStatusBar, QMessageBox
+    QPushButton, QLabel, QFileDialog, QScrollArea, QStatusBar, QMessageBox, QProgressBar
 )
 
-from .parser import process_nat_file
-from .renderer import render_slides
-from .ui_components import SlideViewer, PresentationWindow
+from .cache import ParseCache
+from .extractor import expand_inputs, extract_batch, extract_file
+from .image_cache import ScaledImageCache, ThumbnailCache
+from .qt_renderer import render_slide_qt
+from .renderer import SlideCache, interactive_objects
+from .ui_components import ContinuousView, SlideViewer, PresentationWindow, ThumbnailList, ThumbnailModel
+from .workers import ParseTask, RenderWorker
 
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, cache: ParseCache | None = None, images: ScaledImageCache | None = None,
+                 thumbnails: ThumbnailCache | None = None):
         super().__init__()
+        self.cache = cache
+        self.images = images
+        self.thumbnails = thumbnails
         self.close_action = None
         self.presentation_action = None
+        self.continuous_action = None
         self.setWindowTitle("Notateit Viewer Remake")
         self.setGeometry(100, 100, 1024, 768)
-        self.slides_data = []
+        self.slides = SlideCache(images=self.images, render=render_slide_qt)
         self.current_slide_index = -1
         self.presentation_window = None
-
-        self.slide_viewer = SlideViewer()
+        self.parse_task = None
+        self.document_key: str | None = None
+        self.open_page = 1
+        self.preview: SlideCache | None = None
+        self.worker = RenderWorker(self)
+        self.worker.signals.page_jumped.connect(self.on_page_jumped)
+        self.worker.signals.page_parsed.connect(self.on_page_parsed)
+        self.worker.signals.parsed.connect(self.on_parsed)
+        self.worker.signals.failed.connect(self.on_failed)
+        self.worker.signals.laid_out.connect(self.on_laid_out)
+
+        self.slide_viewer = SlideViewer(self.worker)
         self.scroll_area = QScrollArea()
         self.scroll_area.setWidgetResizable(True)
         self.scroll_area.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.scroll_area.setWidget(self.slide_viewer)
+        self.continuous_view = ContinuousView(self.worker)
+        self.continuous_view.current_changed.connect(self.on_current_changed)
+        self.continuous_view.hide()
+        self.thumbnail_model = ThumbnailModel(self.worker, self.thumbnails)
+        self.thumbnail_list = ThumbnailList(self.thumbnail_model)
+        self.thumbnail_list.clicked.connect(self.on_thumbnail_clicked)
 
         self.prev_button = QPushButton("Previous (Shift+P)")
         self.prev_button.setToolTip("Previous slide (Shift+P)")
@@ -50,14 +74,24 @@ class MainWindow(QMainWindow):
         nav_layout.addStretch()
         nav_layout.addWidget(self.next_button)
 
+        content_layout = QHBoxLayout()
+        content_layout.addWidget(self.thumbnail_list)
+        content_layout.addWidget(self.scroll_area)
+        content_layout.addWidget(self.continuous_view)
+
         main_layout = QVBoxLayout()
-        main_layout.addWidget(self.scroll_area)
+        main_layout.addLayout(content_layout)
         main_layout.addLayout(nav_layout)
 
         central_widget = QWidget()
         central_widget.setLayout(main_layout)
         self.setCentralWidget(central_widget)
         self.setStatusBar(QStatusBar(self))
+        self.load_progress = QProgressBar()
+        self.load_progress.setRange(0, 0)
+        self.load_progress.setMaximumWidth(150)
+        self.load_progress.hide()
+        self.statusBar().addPermanentWidget(self.load_progress)
         self.create_menu_and_actions()
 
         self.prev_button.clicked.connect(self.prev_slide)
@@ -97,61 +131,179 @@ class MainWindow(QMainWindow):
         self.presentation_action.setShortcut(Qt.Key.Key_F5)
         menu_bar.addAction(self.presentation_action)
 
+        self.continuous_action = QAction("Continuous &Scroll (Ctrl+M)", self)
+        self.continuous_action.setCheckable(True)
+        self.continuous_action.toggled.connect(self.set_continuous)
+        self.continuous_action.setShortcut("Ctrl+M")
+        menu_bar.addAction(self.continuous_action)
+
         self.addAction(self.presentation_action)
+        self.addAction(self.continuous_action)
 
-    def open_file(self, /, file_path_str=None):
+    def open_file(self, /, file_path_str=None, page: int = 1):
         if not file_path_str:
-            file_path_str, _ = QFileDialog.getOpenFileName(self, "Open Notabilia File", "", "NAT Files (*.nat)")
+            file_path_str, _ = QFileDialog.getOpenFileName(
+                self, "Open Notabilia File", "", "NAT Files (*.nat);;Extracted Files (*.json *.ndjson)")
         if not file_path_str:
             return
 
         file_path = Path(file_path_str)
+        self.close_file()
         self.statusBar().showMessage(f"Processing {file_path.name}...")
-        QApplication.processEvents()
-
-        try:
-            doc_structure, _ = process_nat_file(file_path)
-            self.statusBar().showMessage("Rendering slides...")
-            QApplication.processEvents()
-            self.slides_data = render_slides(doc_structure)
-            if not self.slides_data:
+        self.load_progress.show()
+        self.open_page = max(page, 1)
+        self.parse_task = self.worker.parse(file_path, self.cache, self.thumbnails, self.open_page)
+
+    @property
+    def loading(self) -> bool:
+        return self.parse_task is not None
+
+    def on_page_jumped(self, task: ParseTask, page, page_count: int):
+        """Show the requested page, parsed ahead from the cached page index, until the parse reaches it"""
+        if task is not self.parse_task or self.current_slide_index != -1 or self.continuous:
+            return
+        self.preview = SlideCache([page], images=self.images, render=render_slide_qt)
+        self.slide_label.setText(f"Slide {self.open_page} of {page_count}")
+        self.worker.show(self.preview, 0, layout=True)
+
+    def on_page_parsed(self, task: ParseTask, page):
+        if task is not self.parse_task:
+            return
+        if not self.slides:
+            self.document_key = task.key
+            if task.layouts is not None:
+                self.slides.restore_layouts(task.layouts)
+        self.slides.append(page)
+        slide_count = len(self.slides)
+        if slide_count == 1:
+            self.thumbnail_model.set_slides(self.slides, task.document)
+        else:
+            self.thumbnail_model.pages_added()
+        self.statusBar().showMessage(f"Processing {task.file_path.name}... {slide_count} slides loaded.")
+        if self.current_slide_index == -1 and slide_count == self.open_page:
+            self.current_slide_index = slide_count - 1
+            self.update_slide_view()
+        elif self.current_slide_index != -1:
+            self.update_slide_label()
+            self.update_ui_state()
+            self.worker.page_added(self.slides, slide_count - 1, layout=True)
+        if self.continuous:
+            self.continuous_view.schedule_relayout()
+
+    def on_parsed(self, task: ParseTask):
+        if task is not self.parse_task:
+            return
+        self.parse_task = None
+        self.load_progress.hide()
+        if self.current_slide_index != -1:
+            self.update_slide_label()
+            self.update_ui_state()
+        else:
+            if not self.slides:
                 QMessageBox.warning(self, "Empty File", "No pages or objects found.")
-                self.current_slide_index = -1
             else:
-                self.current_slide_index = 0
+                self.current_slide_index = len(self.slides) - 1
             self.update_slide_view()
-            self.statusBar().showMessage(f"Opened {file_path.name}. {len(self.slides_data)} slides found.", 5000)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to open or process file:\n{e}")
-            self.statusBar().showMessage("Failed to open file.", 5000)
-            self.slides_data = []
-            self.current_slide_index = -1
-            self.update_ui_state()
+        self.statusBar().showMessage(f"Opened {task.file_path.name}. {len(self.slides)} slides found.", 5000)
+
+    def on_failed(self, task, e: Exception):
+        if not isinstance(task, ParseTask):
+            self.statusBar().showMessage(f"Failed to render slide {task.index + 1}: {e}", 5000)
+            return
+        if task is not self.parse_task:
+            return
+        self.parse_task = None
+        self.load_progress.hide()
+        if self.slides:
+            # keep what was loaded before the file turned out to be damaged
+            if self.current_slide_index == -1:
+                self.current_slide_index = len(self.slides) - 1
+                self.update_slide_view()
+            else:
+                self.update_slide_label()
+                self.update_ui_state()
+            self.statusBar().showMessage(
+                f"Loaded {len(self.slides)} slides of {task.file_path.name}, the rest failed: {e}")
+            return
+        QMessageBox.critical(self, "Error", f"Failed to open or process file:\n{e}")
+        self.statusBar().showMessage("Failed to open file.", 5000)
+        self.slides = SlideCache(images=self.images, render=render_slide_qt)
+        self.current_slide_index = -1
+        self.continuous_view.set_slides(self.slides)
+        self.thumbnail_model.set_slides(self.slides)
+        self.update_slide_view()
+
+    def on_laid_out(self, slides: SlideCache, index: int, layout):
+        if (slides is self.slides and index == self.current_slide_index
+                or slides is self.preview and self.current_slide_index == -1):
+            self.slide_viewer.set_slide(slides, index, layout, interactive_objects(slides.pages[index], layout))
 
     def close_file(self):
-        QApplication.processEvents()
-        self.slides_data = []
+        if self.parse_task is not None:
+            self.parse_task.cancel()
+            self.parse_task = None
+            self.load_progress.hide()
+        if self.cache is not None and self.document_key is not None and self.slides.sizes:
+            # sizes and layouts for placing the slides right away when the document is opened again
+            self.cache.store_layouts(self.document_key, self.slides.export_layouts())
+        self.document_key = None
+        self.slides = SlideCache(images=self.images, render=render_slide_qt)
         self.current_slide_index = -1
+        self.continuous_view.set_slides(self.slides)
+        self.thumbnail_model.set_slides(self.slides)
         self.update_slide_view()
         self.update_ui_state()
-        QApplication.processEvents()
+
+    @property
+    def continuous(self) -> bool:
+        return self.continuous_action.isChecked()
+
+    def set_continuous(self, continuous: bool):
+        self.scroll_area.setVisible(not continuous)
+        self.continuous_view.setVisible(continuous)
+        if continuous:
+            self.continuous_view.set_slides(self.slides)
+        self.update_slide_view()
+
+    def on_current_changed(self, index: int):
+        """The slide in the middle of the continuous view became the current one"""
+        if self.continuous and index != self.current_slide_index:
+            self.current_slide_index = index
+            self.update_slide_label()
+            self.select_thumbnail()
+            self.update_ui_state()
+
+    def on_thumbnail_clicked(self, index):
+        if index.row() != self.current_slide_index:
+            self.current_slide_index = index.row()
+            self.update_slide_view()
+
+    def select_thumbnail(self):
+        self.thumbnail_list.setCurrentIndex(self.thumbnail_model.index(self.current_slide_index))
 
     def update_slide_view(self):
-        if 0 <= self.current_slide_index < len(self.slides_data):
-            slide = self.slides_data[self.current_slide_index]
-            self.slide_viewer.set_slide(slide['image'], slide['interactive_objects'])
-            self.slide_label.setText(f"Slide {self.current_slide_index + 1} of {len(self.slides_data)}")
+        self.preview = None
+        if 0 <= self.current_slide_index < len(self.slides):
+            self.update_slide_label()
+            self.select_thumbnail()
+            if self.continuous:
+                self.continuous_view.relayout()
+                self.continuous_view.scroll_to(self.current_slide_index)
+            else:
+                self.worker.show(self.slides, self.current_slide_index, layout=True)
         else:
-            bg_color = self.palette().color(self.backgroundRole())
-            blank_image = Image.new('RGB', (1, 1), bg_color.toTuple())
-            self.slide_viewer.set_slide(blank_image, [])
+            self.slide_viewer.clear()
             self.slide_label.setText("Open a .nat file to begin")
         self.update_ui_state()
 
+    def update_slide_label(self):
+        more = "+" if self.loading else ""
+        self.slide_label.setText(f"Slide {self.current_slide_index + 1} of {len(self.slides)}{more}")
+
     def update_ui_state(self):
-        has_slides = bool(self.slides_data)
+        has_slides = bool(self.slides)
         self.prev_button.setEnabled(has_slides and self.current_slide_index > 0)
-        self.next_button.setEnabled(has_slides and self.current_slide_index < len(self.slides_data) - 1)
+        self.next_button.setEnabled(has_slides and self.current_slide_index < len(self.slides) - 1)
         self.presentation_action.setEnabled(has_slides)
 
     def prev_slide(self):
@@ -160,22 +312,27 @@ class MainWindow(QMainWindow):
             self.update_slide_view()
 
     def next_slide(self):
-        if self.current_slide_index < len(self.slides_data) - 1:
+        if self.current_slide_index < len(self.slides) - 1:
             self.current_slide_index += 1
             self.update_slide_view()
 
     def start_presentation(self):
-        if not self.slides_data:
+        if not self.slides:
             return
         if self.presentation_window and self.presentation_window.isVisible():
             self.presentation_window.activateWindow()
             return
-        self.presentation_window = PresentationWindow(self.slides_data)
+        self.presentation_window = PresentationWindow(self.slides, self.worker)
         self.presentation_window.showFullScreen()
         self.presentation_window.go_to_slide(self.current_slide_index)
 
+    def closeEvent(self, event):
+        self.close_file()
+        self.worker.shutdown()
+        super().closeEvent(event)
+
     def escape_app(self):
-        if not self.slides_data and self.current_slide_index == -1:
+        if not self.slides and self.current_slide_index == -1:
             self.close()
             return
         self.showMinimized()
@@ -193,34 +350,61 @@ def get_icon_path() -> Path:
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument('input', nargs='?', help='Input .nat file path', type=Path)
+    parser.add_argument('input', nargs='*',
+                        help='Input .nat file path; with -x also directories and glob patterns')
     parser.add_argument('-x', '--extract', help='Extract .nat file', action='store_true')
-    parser.add_argument('-o', '--output', help='Output assets and final .json file directory', type=Path)
+    parser.add_argument('-o', '--output', help='Output assets and final .json file directory '
+                                               '(a subdirectory per file when extracting several)', type=Path)
     parser.add_argument('-m', '--minimize', help='Minimize the final .json file', action='store_true')
+    parser.add_argument('--ndjson', help='Write one JSON page per line instead of a single .json document',
+                        action='store_true')
+    parser.add_argument('--dedup', help='Store identical images once, named by content hash '
+                                        '(shared in <output>/assets when extracting several files)',
+                        action='store_true')
+    parser.add_argument('--bundle', help='Pack all images of a file into one <name>.natpack instead of separate files',
+                        action='store_true')
+    parser.add_argument('-j', '--jobs', help='Worker processes for batch extraction (default: CPU count)', type=int)
+    parser.add_argument('-p', '--page', help='Open the viewer at this page', type=int, default=1)
+    parser.add_argument('--no-cache', help='Bypass the parse, image and thumbnail caches', action='store_true')
+    parser.add_argument('--clear-cache', help='Clear the parse, image and thumbnail caches', action='store_true')
+    parser.add_argument('--cache-assets', help='Also keep image data in the parse cache when extracting',
+                        action='store_true')
     args = parser.parse_args()
-    input_path = args.input
+    input_path = Path(args.input[0]) if args.input else None
+    cache = None if args.no_cache else ParseCache(store_assets=args.cache_assets)
+    if args.clear_cache:
+        ParseCache().clear()
+        ScaledImageCache().clear()
+        ThumbnailCache().clear()
+        if not args.input:
+            return
     if args.extract:
-        if not input_path:
+        files = expand_inputs(args.input)
+        if not files:
             parser.print_help()
             exit(1)
-        data, assets_dir = process_nat_file(input_path, assets_dir=args.output)
-        output_path = assets_dir / f'{input_path.stem}.json'
-        import json
-        print(output_path)
-        with open(output_path, 'w') as output_file:
-            data = json.dumps(data, indent=1) if not args.minimize else json.dumps(data, separators=(',', ':'))
-            output_file.write(data)
-            print(f'Exported to {assets_dir}, saved to {output_path}')
+        if len(files) > 1:
+            exit(1 if extract_batch(files, args.output, args.minimize, args.jobs, cache, args.ndjson, args.dedup,
+                                   args.bundle) else 0)
+        result = extract_file(files[0], args.output, args.minimize, cache, args.ndjson, args.dedup,
+                              bundle=args.bundle)
+        print(result.output_path)
+        print(f'Exported to {result.assets_dir}, saved to {result.output_path}')
+        if args.dedup:
+            print(f'Deduplication saved {result.bytes_saved} bytes')
+            if result.bytes_reused:
+                print(f'{result.bytes_reused} bytes of images were already in the output')
         return
     app = QApplication(sys.argv)
     app_icon = QIcon(str(get_icon_path()))
     if not app_icon.isNull():
         app.setWindowIcon(app_icon)
     app.setDesktopFileName("notateit.viewer.remake")
-    window = MainWindow()
+    window = MainWindow(cache, None if args.no_cache else ScaledImageCache(),
+                        None if args.no_cache else ThumbnailCache())
     window.show()
     if input_path is not None:
-        window.open_file(file_path_str=input_path)
+        window.open_file(file_path_str=input_path, page=args.page)
     sys.exit(app.exec())
 
 """
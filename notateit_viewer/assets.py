@@ -0,0 +1,200 @@
+__author__ = 'Nikita Denissov'
+
+import hashlib
+import os
+import struct
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from .model import ImageObject
+
+ASSET_WRITER_WORKERS = 4
+ASSET_WRITER_MAX_PENDING = 64
+BUNDLE_MAGIC = b'NATPACK\x01'
+BUNDLE_ENTRY = struct.Struct('<QQ')
+BUNDLE_TRAILER = struct.Struct('<QQ8s')
+
+
+def write_asset(path: Path, data: bytes | memoryview, atomic: bool = False):
+    """Write a file; atomic writes go through a temporary file so concurrent writers never expose a partial one"""
+    if not atomic:
+        path.write_bytes(data)
+        return
+    temp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+class AssetWriter:
+    """Background stage that writes asset files while the parser keeps scanning.
+
+    At most max_pending payloads wait in the pool at a time; write() blocks once that many are in flight,
+    which bounds the page buffers kept alive by queued memoryviews. Failed writes are collected and raised
+    together by close().
+    """
+
+    def __init__(self, workers: int = ASSET_WRITER_WORKERS, max_pending: int = ASSET_WRITER_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asset-writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors: list[tuple[Path, OSError]] = []
+        self.lock = threading.Lock()
+        self.futures: list[Future] = []
+
+    def write(self, path: Path, data: bytes | memoryview, atomic: bool = False) -> Future:
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._write, path, data, atomic)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.futures = [pending for pending in self.futures if not pending.done()]
+        self.futures.append(future)
+        return future
+
+    def _write(self, path: Path, data: bytes | memoryview, atomic: bool):
+        try:
+            write_asset(path, data, atomic)
+        except OSError as e:
+            with self.lock:
+                self.errors.append((path, e))
+        finally:
+            self.slots.release()
+
+    def flush(self):
+        """Wait until every file queued so far is on disk"""
+        wait(self.futures)
+        self.futures = []
+
+    def close(self):
+        """Wait until every queued file is on disk, then report failed writes"""
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            path, error = self.errors[0]
+            raise RuntimeError(f"Failed to write {len(self.errors)} asset(s), first {path}: {error}")
+
+
+class AssetStore:
+    """Destination of extracted images: writes <directory>/<name>, through an AssetWriter when given"""
+
+    def __init__(self, directory: Path, writer: AssetWriter | None = None):
+        self.directory = directory
+        self.writer = writer
+        self.pending: list[Future] = []
+
+    def store(self, image: ImageObject, data: bytes | memoryview):
+        """Write an image and record where it went on the image object"""
+        path = self.directory / image.name
+        self._write(path, data)
+        image.file = str(path)
+
+    def _write(self, path: Path, data: bytes | memoryview, atomic: bool = False):
+        if self.writer is None:
+            write_asset(path, data, atomic)
+        else:
+            self.pending.append(self.writer.write(path, data, atomic))
+
+    def take_pending(self) -> list[Future]:
+        """Writes queued since the last call, so callers can tell when a page's files have landed"""
+        pending, self.pending = self.pending, []
+        return pending
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        self.pending = []
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ContentAddressedStore(AssetStore):
+    """Stores every distinct image once as <directory>/<content hash>.png.
+
+    Repeated images, within a document or across documents extracted into the same directory (also from
+    several processes), point at the shared file. bytes_saved counts the payload of repeats seen by this
+    store; bytes_reused counts images that were already in the directory when first seen here.
+    """
+
+    def __init__(self, directory: Path, writer: AssetWriter | None = None):
+        super().__init__(directory, writer)
+        self.known: set[str] = set()
+        self.duplicates = 0
+        self.bytes_saved = 0
+        self.bytes_reused = 0
+
+    def store(self, image: ImageObject, data: bytes | memoryview):
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        path = self.directory / f'{digest}{Path(image.name).suffix}'
+        if digest in self.known:
+            self.duplicates += 1
+            self.bytes_saved += len(data)
+        elif path.is_file():
+            self.bytes_reused += len(data)
+        else:
+            self._write(path, data, atomic=True)
+        self.known.add(digest)
+        image.file = str(path)
+
+
+class BundleStore(AssetStore):
+    """Packs every image of a document into one uncompressed file instead of one file per image.
+
+    Layout: BUNDLE_MAGIC, the PNG payloads back to back, an offset table of (offset, length) entries and
+    a trailer (table offset, entry count, BUNDLE_MAGIC). Documents reference images by bundle, offset and
+    length, so readers can map the bundle and slice images out of it directly.
+    """
+
+    def __init__(self, path: Path, dedup: bool = False):
+        super().__init__(path.parent)
+        self.path = path
+        self.dedup = dedup
+        self.file = open(path, 'wb')
+        self.file.write(BUNDLE_MAGIC)
+        self.entries: list[tuple[int, int]] = []
+        self.known: dict[str, tuple[int, int]] = {}
+        self.bytes_saved = 0
+
+    def store(self, image: ImageObject, data: bytes | memoryview):
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest() if self.dedup else None
+        if digest in self.known:
+            entry = self.known[digest]
+            self.bytes_saved += len(data)
+        else:
+            entry = (self.file.tell(), len(data))
+            self.file.write(data)
+            self.entries.append(entry)
+            if digest:
+                self.known[digest] = entry
+        image.bundle = str(self.path)
+        image.offset, image.length = entry
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        table_offset = self.file.tell()
+        for entry in self.entries:
+            self.file.write(BUNDLE_ENTRY.pack(*entry))
+        self.file.write(BUNDLE_TRAILER.pack(table_offset, len(self.entries), BUNDLE_MAGIC))
+        self.file.close()
+
+
+def read_bundle_table(data: bytes | memoryview) -> list[tuple[int, int]]:
+    """Offset table of a mapped bundle; ValueError when it is not a complete bundle"""
+    table_end = len(data) - BUNDLE_TRAILER.size
+    if table_end < len(BUNDLE_MAGIC):
+        raise ValueError("Not an asset bundle")
+    table_offset, count, magic = BUNDLE_TRAILER.unpack_from(data, table_end)
+    if magic != BUNDLE_MAGIC or data[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC or (
+            table_offset + count * BUNDLE_ENTRY.size != table_end):
+        raise ValueError("Not an asset bundle")
+    return [BUNDLE_ENTRY.unpack_from(data, table_offset + i * BUNDLE_ENTRY.size) for i in range(count)]
@@ -0,0 +1,362 @@
+__author__ = 'Nikita Denissov'
+
+import hashlib
+import marshal
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from pathlib import Path
+from typing import BinaryIO
+
+from .assets import AssetStore
+from .model import AssetRef, ImageObject, Page, TextObject
+from .parser import PageIndex, map_file
+
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'notateit_viewer'
+CACHE_MAX_BYTES = 512 * 2 ** 20
+CACHE_MAX_ENTRY_SHARE = 4
+CACHE_EVICT_TO = 0.9
+CACHE_MAGIC = b'NATC\x04'
+CACHE_HEADER = struct.Struct('<5sQQ')
+CACHE_SUFFIX = '.natc'
+INDEX_SUFFIX = '.idx'
+LAYOUTS_SUFFIX = '.layouts'
+KEY_SUFFIX = '.key'
+KEY_DIGEST_SIZE = 20
+
+
+def content_key(input_file: Path) -> str:
+    return hashlib.blake2b(memoryview(map_file(input_file)), digest_size=KEY_DIGEST_SIZE).hexdigest()
+
+
+class DiskCache:
+    """Directory of cache files written atomically and evicted least recently used first.
+
+    The bytes written are added to a running total, and the directory is only scanned when that total
+    goes over max_bytes; eviction then goes down to CACHE_EVICT_TO of the limit, so a run of writes
+    evicts in batches. Other processes writing to the same directory are caught up with at the next scan.
+    """
+    name = 'cache'
+    suffixes: tuple[str, ...] = ()
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size: int | None = None
+        self.size_lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # sent to extraction worker processes: the lock stays behind and the size is counted there anew
+        state = self.__dict__.copy()
+        del state['size_lock']
+        state['size'] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.size_lock = threading.Lock()
+
+    def _temp_file(self) -> tuple[BinaryIO, Path]:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        return os.fdopen(fd, 'wb'), Path(temp_path)
+
+    def _write(self, path: Path, *parts: bytes):
+        temp_path = None
+        try:
+            file, temp_path = self._temp_file()
+            with file:
+                for part in parts:
+                    file.write(part)
+            os.replace(temp_path, path)
+        except OSError as e:
+            if temp_path is not None:
+                temp_path.unlink(missing_ok=True)
+            print(f"  [!] Warning: Could not write {self.name} entry: {e}")
+            return
+        self._added(sum(len(part) for part in parts))
+
+    def _added(self, written: int):
+        with self.size_lock:
+            if self.size is not None:
+                self.size += written
+                if self.size <= self.max_bytes:
+                    return
+        self.evict()
+
+    def entries(self) -> list[Path]:
+        if not self.directory.is_dir():
+            return []
+        return [path for path in self.directory.iterdir() if path.suffix in self.suffixes]
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits into CACHE_EVICT_TO of max_bytes"""
+        entries = []
+        for path in self.entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in entries:
+                if total <= self.max_bytes * CACHE_EVICT_TO:
+                    break
+                self.remove(path)
+                total -= size
+        with self.size_lock:
+            self.size = total
+
+    @staticmethod
+    def touch(path: Path):
+        """Mark an entry as recently used; it may have been evicted by another process meanwhile"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def remove(self, path: Path):
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self.entries():
+            self.remove(path)
+        with self.size_lock:
+            self.size = None
+
+
+class ParseCache(DiskCache):
+    """On-disk cache of parsed documents, keyed by content hash.
+
+    An entry holds the page structure and the PNG payloads: always for the viewer, which reads the images
+    from the entry, and with store_assets for extraction, which can otherwise reuse the files it extracted.
+    The payloads come first, right after the header, and the page records last, so that an entry is written
+    while pages stream in and a hit maps the entry and hands out AssetRef views into it without copying.
+    An extraction entry whose payloads would take more than a CACHE_MAX_ENTRY_SHARE-th of the cache keeps only
+    the structure; a viewer entry is not written at all then, only its page index.
+    """
+    name = 'parse cache'
+    suffixes = (CACHE_SUFFIX, INDEX_SUFFIX, KEY_SUFFIX, LAYOUTS_SUFFIX)
+
+    def __init__(self, directory: Path = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES, store_assets: bool = False):
+        super().__init__(directory, max_bytes)
+        self.store_assets = store_assets
+        self.max_entry_bytes = max_bytes // CACHE_MAX_ENTRY_SHARE
+
+    def key(self, input_file: Path) -> str:
+        """Content hash of the file. It is remembered under the file's path, size and mtime,
+        so the file is only read again once one of those changes."""
+        stat = input_file.stat()
+        alias = hashlib.blake2b(f'{input_file.resolve()}:{stat.st_size}:{stat.st_mtime_ns}'.encode(),
+                                digest_size=KEY_DIGEST_SIZE).hexdigest()
+        path = self.path(alias, KEY_SUFFIX)
+        try:
+            key = path.read_text()
+        except (OSError, UnicodeDecodeError):
+            key = ''
+        if len(key) == KEY_DIGEST_SIZE * 2:
+            self.touch(path)
+            return key
+        key = content_key(input_file)
+        self._write(path, key.encode())
+        return key
+
+    def path(self, key: str, suffix: str = CACHE_SUFFIX) -> Path:
+        return self.directory / f'{key}{suffix}'
+
+    def load(self, key: str, assets: AssetStore | None) -> list[Page] | None:
+        """Return the cached pages, or None on a miss or when the entry cannot serve this request:
+        in-memory loading needs stored image data, extraction needs stored data or the previously
+        extracted files in the same directory. A plain AssetStore keeps such a file where it is; any other
+        store gets its bytes, so that dedup and bundle output is written the same way as on a miss."""
+        path = self.path(key)
+        try:
+            data = memoryview(map_file(path))
+            magic, structure_offset, structure_length = CACHE_HEADER.unpack_from(data)
+            if magic != CACHE_MAGIC:
+                return None
+            structure = marshal.loads(data[structure_offset:structure_offset + structure_length])
+        except (OSError, ValueError, EOFError, TypeError, struct.error):
+            return None
+
+        pages = []
+        # images are only handed to the store once the whole entry is known to serve the request
+        stores: list[tuple[ImageObject, AssetRef | Path]] = []
+        for page_number, records in structure:
+            objects = []
+            for record in records:
+                if record[0] == TextObject.type:
+                    objects.append(TextObject(record[1]))
+                    continue
+                _, index, offset, length, file = record
+                image = ImageObject(page_number, index)
+                asset = AssetRef(data, offset, length) if offset >= 0 else None
+                if assets is None:
+                    if asset is None:
+                        return None
+                    image.asset = asset
+                elif asset is not None:
+                    stores.append((image, asset))
+                elif file and Path(file).parent == assets.directory and Path(file).is_file():
+                    if type(assets) is AssetStore and Path(file) == assets.directory / image.name:
+                        image.file = file
+                    else:
+                        stores.append((image, Path(file)))
+                else:
+                    return None
+                objects.append(image)
+            pages.append(Page(page_number, objects))
+        for image, source in stores:
+            assets.store(image, source.data() if isinstance(source, AssetRef) else source.read_bytes())
+        self.touch(path)
+        return pages
+
+    def writer(self, key: str, in_memory: bool = False) -> 'ParseCacheWriter':
+        """Writer of a new entry; in_memory when the pages are read without an asset store, like the viewer
+        does, so that the entry is only of use with its payloads"""
+        return ParseCacheWriter(self, key, in_memory)
+
+    def load_index(self, key: str) -> PageIndex | None:
+        path = self.path(key, INDEX_SUFFIX)
+        try:
+            index = marshal.loads(path.read_bytes())
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+        self.touch(path)
+        return [tuple(entry) for entry in index]
+
+    def store_index(self, key: str, index: PageIndex):
+        self._write(self.path(key, INDEX_SUFFIX), marshal.dumps(index))
+
+    def load_layouts(self, key: str):
+        """Slide layouts the viewer stored for the document, as plain data (see SlideCache.export_layouts)"""
+        path = self.path(key, LAYOUTS_SUFFIX)
+        try:
+            layouts = marshal.loads(path.read_bytes())
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+        self.touch(path)
+        return layouts
+
+    def store_layouts(self, key: str, layouts):
+        self._write(self.path(key, LAYOUTS_SUFFIX), marshal.dumps(layouts))
+
+
+class ParseCacheWriter:
+    """Builds a parse cache entry page by page in a temporary file, moved into place by commit().
+
+    In-memory payloads (AssetRef) are written as their page is added; images that only exist as extracted
+    files are read back at commit(), once the asset writer has put them on disk. Only the small page records
+    are kept until then. A failed write drops the entry with a warning.
+    """
+
+    def __init__(self, cache: ParseCache, key: str, in_memory: bool = False):
+        self.cache = cache
+        self.key = key
+        self.in_memory = in_memory
+        self.store_assets = in_memory or cache.store_assets
+        self.structure: list[tuple[int, list]] = []
+        self.deferred: list[list] = []
+        self.payload_bytes = 0
+        self.file: BinaryIO | None = None
+        self.temp_path: Path | None = None
+        try:
+            self.file, self.temp_path = cache._temp_file()
+            self.file.write(CACHE_HEADER.pack(CACHE_MAGIC, 0, 0))
+        except OSError as e:
+            self._fail(e)
+
+    def add(self, page: Page):
+        if self.file is None:
+            return
+        records = []
+        try:
+            for obj in page.objects:
+                if isinstance(obj, TextObject):
+                    records.append((obj.type, obj.value))
+                    continue
+                record = [obj.type, obj.index, -1, 0, obj.file]
+                if self.store_assets and obj.asset is not None:
+                    data = obj.asset.data()
+                    if self._reserve(record, len(data)):
+                        self.file.write(data)
+                elif self.store_assets and obj.file:
+                    self.deferred.append(record)
+                records.append(record)
+        except OSError as e:
+            self._fail(e)
+            return
+        self.structure.append((page.page_number, records))
+
+    def _reserve(self, record: list, length: int) -> bool:
+        """Place a payload of length bytes at the end of the file, unless it would outgrow the entry limit"""
+        if self.payload_bytes + length > self.cache.max_entry_bytes:
+            self._drop_payloads()
+            return False
+        record[2], record[3] = self.file.tell(), length
+        self.payload_bytes += length
+        return True
+
+    def _drop_payloads(self):
+        """Keep only the page structure once the payloads outgrow the entry limit,
+        or drop the entry when it is read without an asset store"""
+        self.store_assets = False
+        if self.in_memory:
+            self.discard()
+            return
+        self.deferred = []
+        for _, records in self.structure:
+            for record in records:
+                if record[0] == ImageObject.type:
+                    record[2], record[3] = -1, 0
+        self.payload_bytes = 0
+        self.file.seek(CACHE_HEADER.size)
+        self.file.truncate()
+
+    def commit(self, index: PageIndex | None = None):
+        """Finish the entry and move it into place; the page index, when given, is stored alongside,
+        also when the entry itself was dropped"""
+        if self.file is not None:
+            self._finish()
+        if index is not None:
+            self.cache.store_index(self.key, index)
+
+    def _finish(self):
+        try:
+            for record in self.deferred:
+                with open(record[4], 'rb') as source:
+                    if not self._reserve(record, os.fstat(source.fileno()).st_size):
+                        break
+                    shutil.copyfileobj(source, self.file)
+            encoded = marshal.dumps(self.structure)
+            structure_offset = self.file.tell()
+            self.file.write(encoded)
+            self.file.seek(0)
+            self.file.write(CACHE_HEADER.pack(CACHE_MAGIC, structure_offset, len(encoded)))
+            self.file.close()
+            os.replace(self.temp_path, self.cache.path(self.key))
+        except OSError as e:
+            self._fail(e)
+            return
+        self.file = self.temp_path = None
+        self.cache._added(structure_offset + len(encoded))
+
+    def _fail(self, error: OSError):
+        print(f"  [!] Warning: Could not write {self.cache.name} entry: {error}")
+        self.discard()
+
+    def discard(self):
+        """Drop the unfinished entry; does nothing after commit()"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.temp_path is not None:
+            self.temp_path.unlink(missing_ok=True)
+            self.temp_path = None
@@ -0,0 +1,178 @@
+__author__ = 'Nikita Denissov'
+
+import glob
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TextIO
+
+from .assets import AssetStore, AssetWriter, BundleStore, ContentAddressedStore
+from .cache import ParseCache
+from .model import Page
+from .parser import iter_processed_pages, prepare_assets_dir, resolve_assets_dir
+
+
+class JsonPageWriter:
+    """Writes pages to the output file as they arrive.
+
+    The JSON layout is byte-for-byte what json.dumps produced for the whole document (indent=1, or compact
+    when minimized); with ndjson every page is one compact line, flushed so readers can follow along.
+    """
+
+    def __init__(self, output_file: TextIO, minimize: bool = False, ndjson: bool = False):
+        self.output_file = output_file
+        self.minimize = minimize
+        self.ndjson = ndjson
+        self.pages_written = 0
+        if not ndjson:
+            output_file.write('{"pages":[' if minimize else '{\n "pages": [')
+
+    def write(self, page: Page):
+        data = page.to_json()
+        if self.ndjson:
+            self.output_file.write(json.dumps(data, separators=(',', ':')) + '\n')
+            self.output_file.flush()
+        elif self.minimize:
+            self.output_file.write((',' if self.pages_written else '') + json.dumps(data, separators=(',', ':')))
+        else:
+            text = json.dumps(data, indent=1).replace('\n', '\n  ')
+            self.output_file.write((',\n  ' if self.pages_written else '\n  ') + text)
+        self.pages_written += 1
+
+    def close(self):
+        if self.ndjson:
+            return
+        if self.minimize:
+            self.output_file.write(']}')
+        else:
+            self.output_file.write('\n ]\n}' if self.pages_written else ']\n}')
+
+
+@dataclass(slots=True)
+class ExtractResult:
+    assets_dir: Path
+    output_path: Path
+    input_bytes: int
+    bytes_saved: int = 0
+    bytes_reused: int = 0
+
+
+def expand_inputs(inputs: list[str]) -> list[Path]:
+    """Resolve files, directories (searched recursively for .nat files) and glob patterns into a file list"""
+    files = []
+    for item in inputs:
+        if any(char in item for char in '*?['):
+            files.extend(Path(match) for match in sorted(glob.glob(item, recursive=True)) if Path(match).is_file())
+        elif Path(item).is_dir():
+            files.extend(sorted(Path(item).rglob('*.nat')))
+        else:
+            files.append(Path(item))
+    return list(dict.fromkeys(files))
+
+
+def output_dirs(files: list[Path], output: Path | None) -> list[Path | None]:
+    """One output directory per input: next to the input by default, or <output>/<stem> for batches"""
+    if output is None or len(files) == 1:
+        return [output] * len(files)
+    dirs, used = [], set()
+    for file in files:
+        name, n = file.stem, 1
+        while name in used:
+            n += 1
+            name = f'{file.stem}_{n}'
+        used.add(name)
+        dirs.append(output / name)
+    return dirs
+
+
+def extract_file(input_file: Path, assets_dir: Path | None, minimize: bool, cache: ParseCache | None = None,
+                 ndjson: bool = False, dedup: bool = False, dedup_dir: Path | None = None,
+                 bundle: bool = False) -> ExtractResult:
+    """Extract one file. With dedup, images are stored once per content in dedup_dir (the file's own
+    output directory by default); with bundle, all images go into a single <stem>.natpack."""
+    assets_dir = resolve_assets_dir(input_file, assets_dir)
+    created_dir = not assets_dir.exists()
+    prepare_assets_dir(input_file, assets_dir)
+    output_path = assets_dir / f'{input_file.stem}{".ndjson" if ndjson else ".json"}'
+    if bundle:
+        assets = BundleStore(assets_dir / f'{input_file.stem}.natpack', dedup)
+    elif dedup:
+        dedup_dir = dedup_dir or assets_dir
+        dedup_dir.mkdir(parents=True, exist_ok=True)
+        assets = ContentAddressedStore(dedup_dir, AssetWriter())
+    else:
+        assets = AssetStore(assets_dir, AssetWriter())
+    assets_closed = False
+    try:
+        with open(output_path, 'w') as output_file:
+            writer = JsonPageWriter(output_file, minimize, ndjson)
+            # a page goes into the JSON only once all of its images are on disk
+            written = deque()
+            for page in iter_processed_pages(input_file, assets, cache):
+                written.append((page, assets.take_pending()))
+                while written and all(future.done() for future in written[0][1]):
+                    writer.write(written.popleft()[0])
+            assets_closed = True
+            assets.close()
+            for page, _ in written:
+                writer.write(page)
+            writer.close()
+    except BaseException as e:
+        # the parse error stays the one raised; failed writes found while shutting down are attached to it
+        if not assets_closed:
+            try:
+                assets.close()
+            except Exception as close_error:
+                e.add_note(f"While closing the assets: {close_error}")
+        output_path.unlink(missing_ok=True)
+        if isinstance(assets, BundleStore):
+            assets.path.unlink(missing_ok=True)
+        if created_dir:
+            try:
+                assets_dir.rmdir()
+            except OSError:
+                pass  # images of the pages parsed before the error stay with the directory
+        raise
+    bytes_saved = assets.bytes_saved if isinstance(assets, (ContentAddressedStore, BundleStore)) else 0
+    bytes_reused = assets.bytes_reused if isinstance(assets, ContentAddressedStore) else 0
+    return ExtractResult(assets_dir, output_path, input_file.stat().st_size, bytes_saved, bytes_reused)
+
+
+def extract_batch(files: list[Path], output: Path | None, minimize: bool, jobs: int | None = None,
+                  cache: ParseCache | None = None, ndjson: bool = False, dedup: bool = False,
+                  bundle: bool = False) -> int:
+    """Extract every file in a process pool; a failing file is reported and the rest carry on.
+    With dedup and an output directory, all documents share <output>/assets.
+    Returns the number of failed files."""
+    started = time.perf_counter()
+    total_bytes = bytes_saved = bytes_reused = failed = done = 0
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(files)))
+    dedup_dir = output / 'assets' if dedup and output and not bundle else None
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(extract_file, file, assets_dir, minimize, cache, ndjson, dedup, dedup_dir,
+                                   bundle): file
+                   for file, assets_dir in zip(files, output_dirs(files, output))}
+        for future in as_completed(futures):
+            done += 1
+            file = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f'[{done}/{len(files)}] FAILED {file}: {e}')
+                continue
+            total_bytes += result.input_bytes
+            bytes_saved += result.bytes_saved
+            bytes_reused += result.bytes_reused
+            print(f'[{done}/{len(files)}] {file} -> {result.output_path}')
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f'Extracted {len(files) - failed}/{len(files)} files in {elapsed:.1f}s with {jobs} workers '
+          f'({(len(files) - failed) / elapsed:.1f} files/s, {total_bytes / 2 ** 20 / elapsed:.1f} MB/s)'
+          + (f', deduplication saved {bytes_saved / 2 ** 20:.1f} MB' if dedup else '')
+          + (f', {bytes_reused / 2 ** 20:.1f} MB already in the output' if bytes_reused else '')
+          + (f', {failed} failed' if failed else ''))
+    return failed
@@ -0,0 +1,163 @@
+__author__ = 'Nikita Denissov'
+
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+from PIL.ImageQt import ImageQt
+from PySide6.QtCore import QBuffer, QByteArray, QIODevice
+from PySide6.QtGui import QImage
+
+from .cache import CACHE_DIR, DiskCache
+from .layout import scale_image
+from .model import ImageObject
+
+IMAGE_CACHE_DIR = CACHE_DIR / 'images'
+IMAGE_CACHE_MAX_BYTES = 256 * 2 ** 20
+IMAGE_CACHE_MAX_PIXELS = 32_000_000
+IMAGE_CACHE_SUFFIX = '.png'
+IMAGE_CACHE_COMPRESS_LEVEL = 1
+THUMBNAIL_CACHE_DIR = CACHE_DIR / 'thumbnails'
+THUMBNAIL_CACHE_MAX_BYTES = 64 * 2 ** 20
+
+
+def image_size(img: Image.Image | QImage) -> tuple[int, int]:
+    return (img.width(), img.height()) if isinstance(img, QImage) else img.size
+
+
+def image_pixels(img: Image.Image | QImage) -> int:
+    width, height = image_size(img)
+    return width * height
+
+
+class ScaledImageCache(DiskCache):
+    """Embedded pictures downscaled for slides, keyed by content hash and target width.
+
+    Recently used images are kept decoded in memory, bounded by their total pixel count and keyed by the
+    content hash of an embedded picture (computed once per AssetRef) or the path of an extracted one, and the
+    target width; so a hit neither reads nor hashes the picture again, and the entries hold on to no document
+    buffer. Every scaled image is also written to disk so that it survives restarts.
+    """
+    name = 'image cache'
+    suffixes = (IMAGE_CACHE_SUFFIX,)
+
+    def __init__(self, directory: Path = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+                 max_pixels: int = IMAGE_CACHE_MAX_PIXELS):
+        super().__init__(directory, max_bytes)
+        self.max_pixels = max_pixels
+        self.images: OrderedDict[tuple[str, int, bool], Image.Image | QImage] = OrderedDict()
+        self.pixels = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def digest(data: bytes | memoryview) -> str:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def path(self, digest: str, width: int) -> Path:
+        return self.directory / f'{digest}-{width}{IMAGE_CACHE_SUFFIX}'
+
+    def get(self, obj: ImageObject, size: tuple[int, int]) -> Image.Image:
+        return self._get(obj, size, False)
+
+    def get_qimage(self, obj: ImageObject, size: tuple[int, int]) -> QImage:
+        """The same picture as an opaque QImage, kept converted so that painting it needs no conversion;
+        a disk cache hit is decoded by Qt directly"""
+        return self._get(obj, size, True)
+
+    def _get(self, obj: ImageObject, size: tuple[int, int], qt: bool) -> Image.Image | QImage:
+        asset = obj.asset
+        if asset is not None and asset.digest is None:
+            asset.digest = self.digest(asset.data())
+        identity = (asset.digest if asset is not None else obj.file, size[0], qt)
+        with self.lock:
+            img = self.images.get(identity)
+            if img is not None:
+                self.images.move_to_end(identity)
+                return img
+
+        if asset is not None:
+            data, digest = asset.data(), asset.digest
+        else:
+            data = Path(obj.file).read_bytes()
+            digest = self.digest(data)
+        path = self.path(digest, size[0])
+        img = self._load_qimage(path) if qt else self._load(path)
+        if img is None or image_size(img) != size:
+            source = Image.open(BytesIO(data))
+            img = scale_image(source, size)
+            if img is not source:
+                self.store(path, img)
+            if qt:
+                # copied so that the QImage owns its pixels rather than borrowing the PIL buffer
+                img = ImageQt(img.convert("RGB")).copy()
+        self._remember(identity, img)
+        return img
+
+    def _load(self, path: Path) -> Image.Image | None:
+        try:
+            img = Image.open(path)
+            img.load()
+        except (OSError, SyntaxError):
+            return None
+        self.touch(path)
+        return img
+
+    def _load_qimage(self, path: Path) -> QImage | None:
+        image = QImage(str(path))
+        if image.isNull():
+            return None
+        self.touch(path)
+        return image.convertToFormat(QImage.Format.Format_RGB32)
+
+    def store(self, path: Path, img: Image.Image):
+        buffer = BytesIO()
+        try:
+            img.save(buffer, 'PNG', compress_level=IMAGE_CACHE_COMPRESS_LEVEL)
+        except (OSError, ValueError):
+            return
+        self._write(path, buffer.getbuffer())
+
+    def _remember(self, key: tuple[str, int, bool], img: Image.Image | QImage):
+        with self.lock:
+            if key not in self.images:
+                self.pixels += image_pixels(img)
+            self.images[key] = img
+            while len(self.images) > 1 and self.pixels > self.max_pixels:
+                _, evicted = self.images.popitem(last=False)
+                self.pixels -= image_pixels(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.pixels = 0
+        super().clear()
+
+
+class ThumbnailCache(DiskCache):
+    """Slide thumbnails keyed by document content hash (the parse cache key), slide index and thumbnail size"""
+    name = 'thumbnail cache'
+    suffixes = (IMAGE_CACHE_SUFFIX,)
+
+    def __init__(self, directory: Path = THUMBNAIL_CACHE_DIR, max_bytes: int = THUMBNAIL_CACHE_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def path(self, document: str, index: int, size: int) -> Path:
+        return self.directory / f'{document}-{index}-{size}{IMAGE_CACHE_SUFFIX}'
+
+    def load(self, document: str, index: int, size: int) -> QImage | None:
+        path = self.path(document, index, size)
+        image = QImage(str(path))
+        if image.isNull():
+            return None
+        self.touch(path)
+        return image
+
+    def store(self, document: str, index: int, size: int, image: QImage):
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+        if image.save(buffer, 'PNG'):
+            self._write(self.path(document, index, size), data.data())
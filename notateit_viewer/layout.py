@@ -0,0 +1,255 @@
+__author__ = 'Nikita Denissov'
+
+import math
+from dataclasses import dataclass, field
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+from typing import Any
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .model import ImageObject, Page
+
+PADDING = 50
+HEADER_FOOTER_EXTRA_PADDING = 25
+MAX_WIDTH_PER_OBJECT = 800
+EMPTY_SLIDE_SIZE = (800, 600)
+TEXT_ADVANCE_CACHE_SIZE = 1 << 16
+TEXT_LAYOUT_CACHE_SIZE = 1024
+
+try:
+    FONT_PATH = Path("arial.ttf")
+    FONT_SIZE = 48
+    FONT_TITLE_SIZE = 64
+    FONT = ImageFont.truetype(str(FONT_PATH), FONT_SIZE)
+    FONT_TITLE = ImageFont.truetype(str(FONT_PATH), FONT_TITLE_SIZE)
+except IOError:
+    print("Arial font not found, default font used.")
+    FONT = ImageFont.load_default(size=48)
+    FONT_TITLE = ImageFont.load_default(size=64)
+
+MEASURE_DRAW = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+LINE_SPACING = 4
+# everything a layout depends on besides the page; stored layouts made under other values are not reused
+LAYOUT_VERSION = (FONT.getname(), FONT.size, FONT_TITLE.size, PADDING, HEADER_FOOTER_EXTRA_PADDING,
+                  MAX_WIDTH_PER_OBJECT, LINE_SPACING)
+
+
+def open_image(obj: ImageObject) -> Image.Image:
+    if obj.asset is not None:
+        return Image.open(BytesIO(obj.asset.data()))
+    return Image.open(obj.file)
+
+
+def scale_image(img: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """LANCZOS resample to size; sources more than four times larger are first box-reduced
+    by an integer factor, leaving at least twice the target resolution for the final resample"""
+    if img.size == size:
+        return img
+    factor = min(img.width // size[0], img.height // max(size[1], 1)) // 2
+    if factor >= 2 and img.mode not in ('1', 'P'):
+        img = img.reduce(factor)
+    return img.resize(size, Image.Resampling.LANCZOS)
+
+
+@lru_cache(maxsize=TEXT_ADVANCE_CACHE_SIZE)
+def text_advance(font: ImageFont.FreeTypeFont, text: str) -> float:
+    return font.getlength(text)
+
+
+@lru_cache(maxsize=TEXT_LAYOUT_CACHE_SIZE)
+def measure_text(text: str, font: ImageFont.FreeTypeFont) -> tuple[int, int]:
+    bbox = MEASURE_DRAW.multiline_textbbox((0, 0), text, font=font)
+    return bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+
+@lru_cache(maxsize=TEXT_LAYOUT_CACHE_SIZE)
+def wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: int):
+    """Break lines by summing cached word and space advances. The exact line bbox is only
+    measured when the sum lands within one em of max_width, where kerning and glyph
+    overhang can decide the break."""
+    lines = []
+    space = text_advance(font, " ")
+    margin = font.size
+    paragraphs = text.splitlines()
+    for paragraph in paragraphs:
+        if not paragraph.strip():
+            lines.append('')
+            continue
+        words = paragraph.split()
+        if not words:
+            continue
+        current_line = [words[0]]
+        line_width = text_advance(font, words[0])
+        for word in words[1:]:
+            word_width = text_advance(font, word)
+            candidate_width = line_width + space + word_width
+            if candidate_width <= max_width - margin or (
+                    candidate_width <= max_width + margin
+                    and font.getbbox(" ".join(current_line) + " " + word)[2] <= max_width):
+                current_line.append(word)
+                line_width = candidate_width
+            else:
+                lines.append(" ".join(current_line))
+                current_line = [word]
+                line_width = word_width
+        lines.append(" ".join(current_line))
+    return "\n".join(lines)
+
+
+@dataclass(slots=True)
+class LayoutBox:
+    """Placed page object: `index` into page.objects, (x, y) where it is painted,
+    and for text the wrapped lines and whether the title font is used"""
+    type: str
+    index: int
+    x: float
+    y: float
+    width: int
+    height: int
+    text: str | None = None
+    title: bool = False
+
+    @property
+    def font(self) -> ImageFont.FreeTypeFont:
+        return FONT_TITLE if self.title else FONT
+
+    @property
+    def rect(self) -> tuple[int, int, int, int]:
+        return int(self.x), int(self.y), int(self.width), int(self.height)
+
+    def lines(self) -> list[tuple[float, float, str]]:
+        """(x, baseline y, line) of every centered text line, placed the way ImageDraw.multiline_text does"""
+        font = self.font
+        lines = self.text.split("\n")
+        widths = [text_advance(font, line) for line in lines]
+        max_width = max(widths)
+        line_height = font.getbbox("A")[3] + LINE_SPACING
+        ascent = font.getmetrics()[0]
+        return [(self.x + (max_width - width) / 2, self.y + ascent + i * line_height, line)
+                for i, (line, width) in enumerate(zip(lines, widths))]
+
+    def to_json(self) -> dict[str, Any]:
+        return {"type": self.type, "index": self.index, "x": self.x, "y": self.y,
+                "width": self.width, "height": self.height, "text": self.text, "title": self.title}
+
+
+@dataclass(slots=True)
+class SlideLayout:
+    """Geometry of a rendered slide; a single-image slide is the image itself at its own size"""
+    width: int
+    height: int
+    boxes: list[LayoutBox] = field(default_factory=list)
+    single_image: bool = False
+
+    def to_json(self) -> dict[str, Any]:
+        return {"width": self.width, "height": self.height, "single_image": self.single_image,
+                "boxes": [box.to_json() for box in self.boxes]}
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> 'SlideLayout':
+        return cls(data['width'], data['height'], [LayoutBox(**box) for box in data['boxes']],
+                   data['single_image'])
+
+
+def _layout_objects(page: Page) -> list[LayoutBox]:
+    """Measure every object at its final size; images are only opened to read their header"""
+    boxes = []
+    for i, obj in enumerate(page.objects):
+        if obj.type == 'Image':
+            try:
+                width, height = open_image(obj).size
+            except FileNotFoundError:
+                print(f'WARNING: Image file not found: {obj.file}')
+                continue
+            if width > MAX_WIDTH_PER_OBJECT:
+                width, height = MAX_WIDTH_PER_OBJECT, int(height * (MAX_WIDTH_PER_OBJECT / width))
+            boxes.append(LayoutBox('image', i, 0, 0, width, height))
+        elif obj.type == 'Text':
+            title = i < 2 < len(page.objects)
+            font = FONT_TITLE if title else FONT
+            wrapped_text = wrap_text(obj.value, font, MAX_WIDTH_PER_OBJECT)
+            width, height = measure_text(wrapped_text, font)
+            boxes.append(LayoutBox('text', i, 0, 0, width, height, wrapped_text, title))
+    return boxes
+
+
+def layout_page(page: Page) -> SlideLayout:
+    """Place every object of a page: the first text as a title, the last text as a footer,
+    and the rest on a centered grid"""
+    if len(page.objects) == 1 and page.objects[0].type == 'Image':
+        img_obj = page.objects[0]
+        if img_obj.asset is not None or Path(img_obj.file).exists():
+            width, height = open_image(img_obj).size
+            return SlideLayout(width, height, [LayoutBox('image', 0, 0, 0, width, height)], True)
+
+    boxes = _layout_objects(page)
+    if not boxes:
+        return SlideLayout(*EMPTY_SLIDE_SIZE)
+
+    header, footer = None, None
+    main_boxes = list(boxes)
+
+    if main_boxes and main_boxes[0].type == 'text':
+        header = main_boxes.pop(0)
+        if not header.title:
+            header.title = True
+            header.width, header.height = measure_text(header.text, header.font)
+
+    if len(main_boxes) > 1 and main_boxes[-1].type == 'text':
+        footer = main_boxes.pop(-1)
+
+    grid_width, grid_height = 0, 0
+    cols = rows = 0
+    col_widths, row_heights = [], []
+    if main_boxes:
+        cols = int(math.ceil(math.sqrt(len(main_boxes))))
+        rows = int(math.ceil(len(main_boxes) / cols))
+        col_widths = [0] * cols
+        row_heights = [0] * rows
+        for i, box in enumerate(main_boxes):
+            c, r = i % cols, i // cols
+            col_widths[c] = max(col_widths[c], box.width)
+            row_heights[r] = max(row_heights[r], box.height)
+        grid_width = sum(col_widths) + PADDING * (cols - 1)
+        grid_height = sum(row_heights) + PADDING * (rows - 1)
+
+    total_width = max(grid_width, header.width if header else 0, footer.width if footer else 0) + PADDING * 2
+    total_height = PADDING
+    if header:
+        total_height += header.height + HEADER_FOOTER_EXTRA_PADDING
+    if main_boxes:
+        total_height += grid_height + HEADER_FOOTER_EXTRA_PADDING
+    if footer:
+        total_height += footer.height
+    total_height += PADDING
+
+    placed = []
+    current_y = PADDING
+    if header:
+        header.x, header.y = (total_width - header.width) / 2, current_y
+        placed.append(header)
+        current_y += header.height + HEADER_FOOTER_EXTRA_PADDING
+
+    if main_boxes:
+        grid_start_y = current_y
+        grid_x_offset = (total_width - grid_width) / 2
+        for r in range(rows):
+            current_x = PADDING + grid_x_offset
+            for c in range(cols):
+                i = r * cols + c
+                if i < len(main_boxes):
+                    box = main_boxes[i]
+                    box.x = current_x + (col_widths[c] - box.width) / 2
+                    box.y = grid_start_y + (row_heights[r] - box.height) / 2
+                    placed.append(box)
+                current_x += col_widths[c] + PADDING
+            grid_start_y += row_heights[r] + PADDING
+        current_y += grid_height + HEADER_FOOTER_EXTRA_PADDING
+
+    if footer:
+        footer.x, footer.y = (total_width - footer.width) / 2, current_y
+        placed.append(footer)
+
+    return SlideLayout(int(total_width), int(total_height), placed)
@@ -0,0 +1,80 @@
+__author__ = 'Nikita Denissov'
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, ClassVar
+
+
+class AssetRef:
+    """Embedded image kept as an offset and length into the decompressed buffer it was found in;
+    `digest` holds its content hash once a cache has computed it"""
+    __slots__ = ('buffer', 'offset', 'length', 'digest')
+
+    def __init__(self, buffer: bytes | memoryview, offset: int, length: int):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self.digest: str | None = None
+
+    def data(self) -> memoryview:
+        return memoryview(self.buffer)[self.offset:self.offset + self.length]
+
+    def save(self, path: Path | str):
+        Path(path).write_bytes(self.data())
+
+
+@dataclass(slots=True)
+class TextObject:
+    value: str
+    type: ClassVar[str] = 'Text'
+
+    def to_json(self) -> dict[str, Any]:
+        return {"type": self.type, "value": self.value}
+
+
+@dataclass(slots=True)
+class ImageObject:
+    """Embedded PNG: extracted to file, packed at offset/length into a bundle,
+    and/or readable in memory through asset"""
+    page_number: int
+    index: int
+    file: str | None = None
+    asset: AssetRef | None = None
+    bundle: str | None = None
+    offset: int = 0
+    length: int = 0
+    type: ClassVar[str] = 'Image'
+
+    @property
+    def name(self) -> str:
+        return Path(self.file).name if self.file else f"page{self.page_number}_img{self.index}.png"
+
+    @property
+    def value(self) -> str:
+        return f"Image {self.index} page {self.page_number}"
+
+    def to_json(self) -> dict[str, Any]:
+        if self.bundle is not None:
+            return {"type": self.type, "bundle": self.bundle, "offset": self.offset, "length": self.length}
+        return {"type": self.type, "file": self.file}
+
+
+PageObject = TextObject | ImageObject
+
+
+@dataclass(slots=True)
+class Page:
+    page_number: int
+    objects: list[PageObject] = field(default_factory=list)
+
+    def to_json(self) -> dict[str, Any]:
+        return {"page_number": self.page_number, "objects": [obj.to_json() for obj in self.objects]}
+
+
+@dataclass(slots=True)
+class Document:
+    pages: list[Page] = field(default_factory=list)
+
+    def to_json(self) -> dict[str, Any]:
+        """Plain structure written by extraction, unchanged from the original dict output"""
+        return {"pages": [page.to_json() for page in self.pages]}
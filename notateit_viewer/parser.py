@@ -1,118 +1,330 @@
 __author__ = 'Nikita Denissov'
 
+import json
+import mmap
 import re
 import struct
 import zlib
+from collections.abc import Iterable, Iterator
 from pathlib import Path
-from typing import Any
+
+from .assets import AssetStore, read_bundle_table
+from .model import AssetRef, Document, ImageObject, Page, PageObject, TextObject
 
 HEADER_LENGTH = 13
 PAGE_BREAK_REGEX = re.compile(b'\xff\xff\xff\xff\x00\x00\x00\x00', re.DOTALL)
 PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHUNK_HEADER = struct.Struct('>I4s')
+PNG_CHUNK_CRC_LENGTH = 4
 ZLIB_HEADER = b'x\x9c'
 TEXT_REGEX = re.compile(b'(.{4})([^<\0]+)<\0')
+RECORD_REGEX = re.compile(b'(?P<png>' + re.escape(PNG_SIGNATURE) + b')|(?P<length>.{4})(?P<text>[^<\0]+)<\0')
+CHUNK_SIZE = 1 << 20
+
+PageIndex = list[tuple[int, int, int]]
+
+
+def find_png_end(data: bytes | memoryview, png_start: int) -> int:
+    """Walk the chunks of the PNG starting at png_start and return the offset just past its IEND chunk,
+    or -1 if the image is truncated or its chunk structure is broken"""
+    position = png_start + len(PNG_SIGNATURE)
+    while position + PNG_CHUNK_HEADER.size <= len(data):
+        length, chunk_type = PNG_CHUNK_HEADER.unpack_from(data, position)
+        if not chunk_type.isalpha():
+            return -1
+        position += PNG_CHUNK_HEADER.size + length + PNG_CHUNK_CRC_LENGTH
+        if chunk_type == b'IEND':
+            return position if position <= len(data) else -1
+    return -1
 
 
-def parse_page_simple(page_data: bytes, page_num: int, assets_dir: Path) -> list[dict[str, Any]]:
+def parse_page_simple(page_data: bytes | memoryview, page_num: int,
+                      assets: AssetStore | Path | None) -> list[PageObject]:
+    """Parse the records of a page; images are written to the asset store (or directory),
+    or only referenced when it is None"""
+    if assets is not None and not isinstance(assets, AssetStore):
+        assets = AssetStore(Path(assets))
     objects = []
     cursor = 0
     img_index = 0
 
     while cursor < len(page_data):
-        text_match = TEXT_REGEX.search(page_data, cursor)
-        png_pos = page_data.find(PNG_SIGNATURE, cursor)
-
-        next_text_pos = text_match.start() if text_match else -1
-        next_png_pos = png_pos if png_pos != -1 else -1
-
-        if next_text_pos == -1 and next_png_pos == -1:
+        record = RECORD_REGEX.search(page_data, cursor)
+        if not record:
             break
 
-        if next_text_pos != -1 and (next_text_pos < next_png_pos or next_png_pos == -1):
-            length_bytes, text_bytes = text_match.groups()
+        if record.lastgroup == 'text':
+            length_bytes, text_bytes = record.group('length', 'text')
             try:
                 declared_len = struct.unpack('<I', length_bytes)[0]
                 if len(text_bytes) > declared_len:
                     text_bytes = text_bytes[:declared_len]
                 value = text_bytes.decode(errors='replace').strip()
                 if value:
-                    objects.append({"type": "Text", "value": value})
+                    objects.append(TextObject(value))
             except (struct.error, UnicodeDecodeError) as e:
-                print(
-                    f"  [!] Warning: Skipping corrupted text block at page {page_num} offset {text_match.start()}: {e}")
-            cursor = text_match.end()
-        elif next_png_pos != -1:
-            iend_pos = page_data.find(b'IEND', next_png_pos)
-            if iend_pos == -1:
-                print(
-                    f"  [!] Warning: Found PNG signature at page {page_num} offset {next_png_pos} but no IEND marker. Skipping.")
-                cursor = next_png_pos + len(PNG_SIGNATURE)
+                print(f"  [!] Warning: Skipping corrupted text block at page {page_num} offset {record.start()}: {e}")
+            cursor = record.end()
+        else:
+            png_start = record.start()
+            png_end = find_png_end(page_data, png_start)
+            if png_end == -1:
+                print(f"  [!] Warning: Found PNG signature at page {page_num} offset {png_start} "
+                      f"but the image is truncated before its IEND chunk. Skipping.")
+                cursor = png_start + len(PNG_SIGNATURE)
                 continue
 
-            png_end = iend_pos + 8
-            png_data = page_data[next_png_pos:png_end]
-
             img_index += 1
-            filename = f"page{page_num}_img{img_index}.png"
-            filepath = assets_dir / filename
-            filepath.write_bytes(png_data)
-
-            objects.append({"type": "Image", "file": str(filepath)})
+            image = ImageObject(page_num, img_index)
+            if assets is None:
+                image.asset = AssetRef(page_data, png_start, png_end - png_start)
+            else:
+                assets.store(image, memoryview(page_data)[png_start:png_end])
+            objects.append(image)
             cursor = png_end
-        else:
-            break
     return objects
 
 
-def parse_document(data: bytes, assets_dir: Path) -> dict[str, Any]:
-    doc_structure = {
-        "pages": []
-    }
-
+def split_pages(data: bytes | memoryview) -> Iterator[bytes | memoryview]:
     page_starts = sorted(list(set([0] + [m.end() for m in PAGE_BREAK_REGEX.finditer(data)])))
     page_boundaries = page_starts + [len(data)]
-    page_num = 1
-
     for i in range(len(page_boundaries) - 1):
-        page_start, page_end = page_boundaries[i], page_boundaries[i + 1]
-        if page_end - page_start < 10:
+        yield data[page_boundaries[i]:page_boundaries[i + 1]]
+
+
+def iter_pages(chunks: Iterable[bytes]) -> Iterator[memoryview]:
+    """Split a stream of decompressed chunks into pages, matching page breaks across chunk edges.
+
+    Pages are memoryview slices of the buffer they were assembled in. Once a break is found the buffer is
+    handed over to the views and only the bytes after the last break, at most one chunk, are copied into
+    a fresh one; the old buffer lives as long as a page (or an AssetRef into it) does.
+    """
+    buffer = bytearray()
+    scan_from = 0
+    overlap = len(PAGE_BREAK_REGEX.pattern) - 1
+    for chunk in chunks:
+        buffer += chunk
+        page_start = 0
+        while page_break := PAGE_BREAK_REGEX.search(buffer, scan_from):
+            if not page_start:
+                view = memoryview(buffer)
+            yield view[page_start:page_break.end()]
+            page_start = scan_from = page_break.end()
+        if page_start:
+            buffer = bytearray(view[page_start:])
+        scan_from = max(0, len(buffer) - overlap)
+    if buffer:
+        yield memoryview(buffer)
+
+
+def iter_document(pages: Iterable[bytes | memoryview], assets: AssetStore | Path | None,
+                  index: PageIndex | None = None) -> Iterator[Page]:
+    """Parse pages in order; when index is given, (offset, length, page_number) of every non-empty page
+    in the decompressed stream is appended to it"""
+    page_num = 1
+    offset = 0
+    for page_data in pages:
+        page_start, offset = offset, offset + len(page_data)
+        if len(page_data) < 10:
             continue
-        page_data = data[page_start:page_end]
-        page_objects = parse_page_simple(page_data, page_num, assets_dir)
+        page_objects = parse_page_simple(page_data, page_num, assets)
         if page_objects:
-            doc_structure["pages"].append({"page_number": page_num, "objects": page_objects})
+            if index is not None:
+                index.append((page_start, len(page_data), page_num))
+            yield Page(page_num, page_objects)
             page_num += 1
 
-    return doc_structure
 
+def parse_document(data: bytes | memoryview, assets: AssetStore | Path | None) -> Document:
+    return Document(list(iter_document(split_pages(data), assets)))
+
+
+def map_file(input_file: Path) -> mmap.mmap | bytes:
+    """Map a file read-only; the mapping is released once the last view into it is gone"""
+    with input_file.open('rb') as file:
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b''
+
+
+def _find_compressed_body(data: mmap.mmap | bytes) -> int | None:
+    if data[HEADER_LENGTH:HEADER_LENGTH + len(ZLIB_HEADER)] == ZLIB_HEADER:
+        return HEADER_LENGTH
+    header_start = data.find(ZLIB_HEADER)
+    return None if header_start == -1 else header_start
+
+
+def _inflate(body: memoryview, wbits: int) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj(wbits)
+    position = 0
+    while not decompressor.eof:
+        compressed = decompressor.unconsumed_tail
+        if not compressed:
+            compressed = body[position:position + CHUNK_SIZE]
+            position += len(compressed)
+        if not compressed:
+            raise zlib.error("incomplete or truncated stream")
+        chunk = decompressor.decompress(compressed, CHUNK_SIZE)
+        if chunk:
+            yield chunk
+
+
+def iter_decompressed(body: memoryview) -> Iterator[bytes]:
+    """Yield the inflated body in chunks of at most CHUNK_SIZE bytes"""
+    produced = False
+    for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+        try:
+            for chunk in _inflate(body, wbits):
+                produced = True
+                yield chunk
+            return
+        except zlib.error as e:
+            if produced or wbits < 0:
+                raise RuntimeError(f"Decompression failed: {e}")
+
+
+def iter_page_data(input_file: Path) -> Iterator[bytes | memoryview]:
+    """Yield raw pages of a .nat file: zero-copy slices of the mapped file when it is stored uncompressed,
+    otherwise pages inflated on the fly"""
+    data = map_file(input_file)
+    body_start = _find_compressed_body(data)
+    view = memoryview(data)
+    if body_start is None:
+        yield from split_pages(view)
+    else:
+        yield from iter_pages(iter_decompressed(view[body_start:]))
+
+
+def iter_nat_file(input_file: Path, assets: AssetStore | Path | None,
+                  index: PageIndex | None = None) -> Iterator[Page]:
+    """Parse a .nat file page by page without holding the whole decompressed document in memory"""
+    yield from iter_document(iter_page_data(input_file), assets, index)
+
+
+def read_page_data(input_file: Path, offset: int, length: int) -> bytes | memoryview:
+    """Return length bytes at offset of the decompressed stream, inflating no further than needed"""
+    data = map_file(input_file)
+    body_start = _find_compressed_body(data)
+    view = memoryview(data)
+    if body_start is None:
+        return view[offset:offset + length]
+    page_data = bytearray()
+    position = 0
+    for chunk in iter_decompressed(view[body_start:]):
+        chunk_end = position + len(chunk)
+        if chunk_end > offset:
+            page_data += chunk[max(0, offset - position):offset + length - position]
+        position = chunk_end
+        if position >= offset + length:
+            break
+    return memoryview(page_data)
+
+
+class NatDocument:
+    """A .nat file together with its page index, for parsing single pages on demand"""
+
+    def __init__(self, input_file: Path, index: PageIndex):
+        self.input_file = input_file
+        self.index = index
+
+    @property
+    def page_count(self) -> int:
+        return len(self.index)
+
+
+def parse_page(doc: NatDocument, page_number: int, assets: AssetStore | Path | None = None) -> Page:
+    """Parse only the given 1-based page of an indexed document"""
+    if not 1 <= page_number <= doc.page_count:
+        raise IndexError(f"Page {page_number} out of range 1..{doc.page_count}")
+    offset, length, page_num = doc.index[page_number - 1]
+    page_data = read_page_data(doc.input_file, offset, length)
+    return Page(page_num, parse_page_simple(page_data, page_num, assets))
 
-def process_nat_file(input_file: Path, assets_dir: Path = None) -> tuple[dict[str, Any], Path]:
+
+def resolve_assets_dir(input_file: Path, assets_dir: Path = None) -> Path:
+    """The given output directory, or one named after the input file next to it"""
     base_name = input_file.with_suffix('')
     if not assets_dir:
         assets_dir = base_name.with_suffix('')
+    return assets_dir
 
-    file_data = input_file.read_bytes()
 
+def prepare_assets_dir(input_file: Path, assets_dir: Path = None) -> Path:
+    assets_dir = resolve_assets_dir(input_file, assets_dir)
     if not assets_dir.exists():
         assets_dir.mkdir(parents=True)
+    return assets_dir
 
-    compressed_body = file_data[HEADER_LENGTH:]
-    decompressed_data = None
-    if not compressed_body.startswith(ZLIB_HEADER):
-        header_start = file_data.find(ZLIB_HEADER)
-        if header_start == -1:
-            decompressed_data = file_data
-        else:
-            compressed_body = file_data[header_start:]
 
-    if not decompressed_data:
-        try:
-            decompressed_data = zlib.decompress(compressed_body)
-        except zlib.error:
-            try:
-                decompressed_data = zlib.decompress(compressed_body, -15)
-            except zlib.error as e:
-                raise RuntimeError(f"Decompression failed: {e}")
+def iter_processed_pages(input_file: Path, assets: AssetStore | None, cache=None,
+                         key: str | None = None) -> Iterator[Page]:
+    """Yield the pages of a .nat file as they are parsed. A ParseCache, when given, is consulted first
+    (under `key` when the caller already has it); on a miss the entry is written page by page and committed
+    once the last page has been parsed, so no page is kept here after it has been yielded."""
+    if cache is None:
+        yield from iter_nat_file(input_file, assets)
+        return
+
+    key = key or cache.key(input_file)
+    pages = cache.load(key, assets)
+    if pages is not None:
+        yield from pages
+        return
+
+    index = []
+    writer = cache.writer(key, in_memory=assets is None)
+    try:
+        for page in iter_nat_file(input_file, assets, index):
+            writer.add(page)
+            yield page
+        if assets is not None:
+            assets.flush()
+        writer.commit(index)
+    finally:
+        writer.discard()
 
-    document_structure = parse_document(decompressed_data, assets_dir)
-    return document_structure, assets_dir
+
+def process_nat_file(input_file: Path, assets_dir: Path = None, extract_assets: bool = True,
+                     cache=None) -> tuple[Document, Path | None]:
+    """Parse a .nat file; without extract_assets nothing is written and images are returned as AssetRef"""
+    assets_dir = prepare_assets_dir(input_file, assets_dir) if extract_assets else None
+    assets = AssetStore(assets_dir) if assets_dir else None
+    return Document(list(iter_processed_pages(input_file, assets, cache))), assets_dir
+
+
+def load_extracted(json_path: Path) -> Document:
+    """Load an extraction result (.json or .ndjson) for viewing; bundled images are mapped, not read,
+    and checked against the offset table of their bundle"""
+    with open(json_path) as file:
+        if json_path.suffix == '.ndjson':
+            pages = [json.loads(line) for line in file if line.strip()]
+        else:
+            pages = json.load(file)['pages']
+
+    bundles = {}
+    document = Document()
+    for page in pages:
+        objects = []
+        img_index = 0
+        for obj in page['objects']:
+            if obj['type'] == TextObject.type:
+                objects.append(TextObject(obj['value']))
+                continue
+            img_index += 1
+            image = ImageObject(page['page_number'], img_index, file=obj.get('file'))
+            if 'bundle' in obj:
+                bundle_path = Path(obj['bundle'])
+                if not bundle_path.is_file():
+                    bundle_path = json_path.parent / bundle_path.name
+                if bundle_path not in bundles:
+                    data = map_file(bundle_path)
+                    bundles[bundle_path] = data, set(read_bundle_table(data))
+                data, entries = bundles[bundle_path]
+                image.bundle, image.offset, image.length = obj['bundle'], obj['offset'], obj['length']
+                if (image.offset, image.length) not in entries:
+                    raise ValueError(f"{bundle_path} holds no image at offset {image.offset}, length {image.length}")
+                image.asset = AssetRef(data, image.offset, image.length)
+            objects.append(image)
+        document.pages.append(Page(page['page_number'], objects))
+    return document
@@ -0,0 +1,129 @@
+__author__ = 'Nikita Denissov'
+
+import threading
+from pathlib import Path
+
+from PIL import ImageFont
+from PySide6.QtCore import QBuffer, QByteArray, QPoint, QPointF, QRect, QRectF, QSize
+from PySide6.QtGui import QColor, QFont, QFontDatabase, QFontMetricsF, QImage, QImageReader, QPainter
+
+from .layout import LayoutBox, SlideLayout, layout_page, text_advance
+from .model import ImageObject, Page
+from .renderer import BACKGROUND_COLOR, TEXT_COLOR, Slide, interactive_objects
+
+_qt_fonts: dict[ImageFont.FreeTypeFont, QFont] = {}
+_qt_fonts_lock = threading.Lock()
+
+
+def qt_font(font: ImageFont.FreeTypeFont) -> QFont:
+    """QFont for the same font file or embedded font data the layout was measured with"""
+    with _qt_fonts_lock:
+        qfont = _qt_fonts.get(font)
+        if qfont is None:
+            if isinstance(font.path, (str, Path)):
+                font_id = QFontDatabase.addApplicationFont(str(font.path))
+            else:
+                font_id = QFontDatabase.addApplicationFontFromData(QByteArray(font.font_bytes))
+            families = QFontDatabase.applicationFontFamilies(font_id) if font_id != -1 else []
+            qfont = QFont(families[0] if families else font.getname()[0])
+            qfont.setPixelSize(font.size)
+            _qt_fonts[font] = qfont
+        return qfont
+
+
+def load_qimage(obj: ImageObject, size: tuple[int, int] | None = None, opaque: bool = False,
+                clip: QRect | None = None) -> QImage:
+    """Decode a picture with Qt, scaled to size while reading when given, and only its `clip` part when given;
+    opaque images drop the alpha channel the way pasting into the PIL slide does"""
+    if obj.asset is not None:
+        device = QBuffer()
+        device.setData(obj.asset.data().tobytes())
+        reader = QImageReader(device)
+    else:
+        reader = QImageReader(str(obj.file))
+    if size is not None:
+        reader.setScaledSize(QSize(*size))
+    if clip is not None:
+        reader.setClipRect(clip)
+    image = reader.read()
+    if image.isNull():
+        raise ValueError(f"Could not decode {obj.name}: {reader.errorString()}")
+    return image.convertToFormat(QImage.Format.Format_RGB32 if opaque else QImage.Format.Format_ARGB32_Premultiplied)
+
+
+def box_extent(box: LayoutBox) -> QRect:
+    """Area a box may paint into; text ink can reach past the measured bbox by up to one em"""
+    rect = QRect(*box.rect)
+    if box.type == 'text':
+        margin = box.font.size
+        rect.adjust(-margin, -margin, margin, margin)
+    return rect
+
+
+def paint_boxes(painter: QPainter, page: Page, boxes: list[LayoutBox], images=None):
+    painter.setRenderHint(QPainter.RenderHint.TextAntialiasing)
+    painter.setPen(QColor(*TEXT_COLOR))
+    for box in boxes:
+        if box.type == 'image':
+            obj, size = page.objects[box.index], (box.width, box.height)
+            img = images.get_qimage(obj, size) if images is not None else load_qimage(obj, size, opaque=True)
+            painter.drawImage(QPoint(int(box.x), int(box.y)), img)
+        elif box.type == 'text':
+            qfont = QFont(qt_font(box.font))
+            metrics = QFontMetricsF(qfont)
+            for x, baseline, line in box.lines():
+                # FreeType advances are whole pixels; spread the difference over the line so that
+                # it keeps the width the layout measured
+                spacing = (text_advance(box.font, line) - metrics.horizontalAdvance(line)) / max(len(line), 1)
+                qfont.setLetterSpacing(QFont.SpacingType.AbsoluteSpacing, spacing)
+                painter.setFont(qfont)
+                painter.drawText(QPointF(x, baseline), line)
+
+
+def paint_layout_qt(page: Page, layout: SlideLayout, images=None) -> QImage:
+    """Paint a layout straight into a QImage that can be shown without further conversion"""
+    if layout.single_image:
+        return load_qimage(page.objects[0])
+    slide = QImage(layout.width, layout.height, QImage.Format.Format_RGB32)
+    slide.fill(QColor(*BACKGROUND_COLOR))
+    painter = QPainter(slide)
+    paint_boxes(painter, page, layout.boxes, images)
+    painter.end()
+    return slide
+
+
+def paint_layout_region(page: Page, layout: SlideLayout, rect: QRect, images=None) -> QImage:
+    """Paint only `rect` of a multi-object layout, touching just the boxes that reach into it"""
+    tile = QImage(rect.size(), QImage.Format.Format_RGB32)
+    tile.fill(QColor(*BACKGROUND_COLOR))
+    painter = QPainter(tile)
+    painter.translate(-rect.topLeft())
+    paint_boxes(painter, page, [box for box in layout.boxes if box_extent(box).intersects(rect)], images)
+    painter.end()
+    return tile
+
+
+def paint_thumbnail(page: Page, layout: SlideLayout, size: int) -> QImage:
+    """Paint a layout scaled down to fit a size x size box without painting it at full size first;
+    pictures are decoded and downscaled straight to their size in the thumbnail"""
+    scale = min(size / layout.width, size / layout.height, 1)
+    thumbnail = QImage(max(round(layout.width * scale), 1), max(round(layout.height * scale), 1),
+                       QImage.Format.Format_RGB32)
+    thumbnail.fill(QColor(*BACKGROUND_COLOR))
+    painter = QPainter(thumbnail)
+    painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+    painter.scale(scale, scale)
+    for box in layout.boxes:
+        if box.type == 'image':
+            target = (max(round(box.width * scale), 1), max(round(box.height * scale), 1))
+            img = load_qimage(page.objects[box.index], target, opaque=True)
+            painter.drawImage(QRectF(box.x, box.y, box.width, box.height), img)
+    paint_boxes(painter, page, [box for box in layout.boxes if box.type == 'text'])
+    painter.end()
+    return thumbnail
+
+
+def render_slide_qt(page: Page, layout: SlideLayout | None = None, images=None) -> Slide:
+    if layout is None:
+        layout = layout_page(page)
+    return Slide(paint_layout_qt(page, layout, images), interactive_objects(page, layout))
@@ -1,19 +1,35 @@
 __author__ = 'Nikita Denissov'
 
-import os
 import shutil
+from bisect import bisect_right
+from collections import OrderedDict
 
-from PIL import Image
-from PIL.ImageQt import ImageQt
-from PySide6.QtCore import Qt, QPoint
-from PySide6.QtGui import QAction, QMouseEvent, QShortcut, QKeySequence
-from PySide6.QtGui import QPixmap
+from PySide6.QtCore import Qt, QAbstractListModel, QEvent, QModelIndex, QPoint, QRect, QSize, QTimer, Signal
+from PySide6.QtGui import QAction, QColor, QMouseEvent, QShortcut, QKeySequence
+from PySide6.QtGui import QImage, QPainter, QPen, QPixmap
 from PySide6.QtWidgets import (
     QMenu, QFileDialog, QMessageBox, QApplication, QDialog,
-    QTextEdit, QVBoxLayout, QHBoxLayout, QPushButton
+    QTextEdit, QVBoxLayout, QHBoxLayout, QPushButton, QScrollArea, QToolTip, QAbstractScrollArea, QListView
 )
 from PySide6.QtWidgets import (QWidget, QLabel, QSizePolicy)
 
+from .image_cache import ThumbnailCache
+from .layout import EMPTY_SLIDE_SIZE, SlideLayout
+from .renderer import SlideCache, open_image
+from .workers import CURRENT_SLIDE_PRIORITY, PREFETCH_PRIORITY, RenderWorker
+
+TILE_SIZE = 512
+TILE_CACHE_MAX_TILES = 48
+PRESENTATION_CACHE_MAX_PIXMAPS = 8
+RESIZE_SETTLE_MS = 150
+HIT_CELL_SIZE = 128
+FOCUS_COLOR = QColor('#0078d7')
+SLIDE_GAP = 20
+CONTINUOUS_MAX_TILES = 64
+PLACEHOLDER_COLOR = QColor(235, 235, 235)
+THUMBNAIL_SIZE = 160
+THUMBNAIL_MAX_PIXMAPS = 256
+
 
 class TextViewerDialog(QDialog):
     def __init__(self, text, parent=None):
@@ -41,168 +57,621 @@ class TextViewerDialog(QDialog):
         self.resize(500, 400)
 
 
-class InteractiveObjectWidget(QPushButton):
-    """Interactive object (text or image)"""
+class HitIndex:
+    """Uniform grid over the slide: each cell lists the objects whose rects overlap it"""
 
-    def __init__(self, obj_data, parent=None):
-        super().__init__(parent)
-        self.obj_data = obj_data
-
-        self.setStyleSheet("QPushButton{background-color:transparent;border:none;}"
-                           "QPushButton:focus{border:2px solid #0078d7;}")
-
-        obj_type = self.obj_data['data']['type']
-        value = self.obj_data['data']['value']
-        if obj_type == 'Text':
-            self.setToolTip(f'Text Block\n'
-                            f'- Double-click or Ctrl+Enter to open\n'
-                            f'- Ctrl+C to copy\n'
-                            f'"{value}"')
-        elif obj_type == 'Image':
-            self.setToolTip(f'{value} Block\n'
-                            f'- Double-click or Ctrl+Enter to open\n'
-                            f'- Ctrl+S to save')
-
-        self.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
-        self.customContextMenuRequested.connect(self.show_context_menu)
-
-        self.shortcut_open = QShortcut(QKeySequence("Ctrl+Return"), self)
-        self.shortcut_open.activated.connect(self.do_default_action)
-
-        self.shortcut_copy = QShortcut(QKeySequence("Ctrl+C"), self)
-        self.shortcut_copy.activated.connect(
-            lambda: self.copy_text(self.obj_data['data'])
-            if self.obj_data['data']['type'] == 'Text' else None
-        )
+    def __init__(self, objects: list, cell_size: int = HIT_CELL_SIZE):
+        self.objects = objects
+        self.cell_size = cell_size
+        self.cells: dict[tuple[int, int], list[int]] = {}
+        for i, obj in enumerate(objects):
+            rect = obj.rect
+            for cy in range(rect.top() // cell_size, rect.bottom() // cell_size + 1):
+                for cx in range(rect.left() // cell_size, rect.right() // cell_size + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
 
-        self.shortcut_save = QShortcut(QKeySequence("Ctrl+S"), self)
-        self.shortcut_save.activated.connect(
-            lambda: self.save_image_as(self.obj_data['data'])
-            if self.obj_data['data']['type'] == 'Image' else None
-        )
+    def at(self, point: QPoint) -> int:
+        """Index of the topmost object under point, or -1"""
+        cell = self.cells.get((point.x() // self.cell_size, point.y() // self.cell_size), ())
+        for i in reversed(cell):
+            if self.objects[i].rect.contains(point):
+                return i
+        return -1
+
+
+class SlideViewer(QWidget):
+    """Shows a slide layout tile by tile, only where the scroll viewport exposes it.
+    Tiles are painted on the RenderWorker and kept in a small LRU cache, so memory follows the screen size
+    and not the slide size; the picture of a single-image slide is decoded on the worker only where it is
+    visible and cut into the same tiles. Until a tile arrives its area is filled with a placeholder.
 
-        self._set_shortcuts_enabled(False)
+    Interactive objects (text or image) are hit-tested on this one widget: double-click or Ctrl+Enter opens,
+    Ctrl+C copies text, Ctrl+S saves an image, and Tab moves the keyboard focus between objects."""
+
+    def __init__(self, worker: RenderWorker, parent=None, tile_size: int = TILE_SIZE,
+                 max_tiles: int = TILE_CACHE_MAX_TILES):
+        super().__init__(parent)
+        self.worker = worker
+        self.worker.signals.tiled.connect(self._on_tiled)
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.slides: SlideCache | None = None
+        self.index = -1
+        self.layout: SlideLayout | None = None
+        self.tiles: OrderedDict[tuple[int, int, int], tuple[SlideLayout, QPixmap]] = OrderedDict()
+        self.objects = []
+        self.hit_index = HitIndex([])
+        self.focus_index = -1
+        self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
+        self.setContextMenuPolicy(Qt.ContextMenuPolicy.DefaultContextMenu)
+
+        for keys, action in (("Ctrl+Return", self.do_default_action),
+                             ("Ctrl+C", lambda: self.copy_text(self.focused_data('Text'))),
+                             ("Ctrl+S", lambda: self.save_image_as(self.focused_data('Image')))):
+            shortcut = QShortcut(QKeySequence(keys), self)
+            shortcut.setContext(Qt.ShortcutContext.WidgetShortcut)
+            shortcut.activated.connect(action)
+
+    def set_slide(self, slides: SlideCache | None, index: int, layout: SlideLayout | None, objects: list):
+        self.slides, self.index, self.layout = slides, index, layout
+        self.objects = objects
+        self.hit_index = HitIndex(objects)
+        self.focus_index = -1
+        self.worker.show_tiles(self, [layout] if layout is not None else [])
+
+        self.setMinimumSize(self.slide_rect().size())
+        self.updateGeometry()
+        self.request_tiles()
+        self.update()
+
+    def clear(self):
+        self.set_slide(None, -1, None, [])
+
+    def slide_rect(self) -> QRect:
+        if self.layout is None:
+            return QRect()
+        return QRect(0, 0, self.layout.width, self.layout.height)
+
+    def visible_rect(self) -> QRect:
+        """Part of the slide inside the scroll viewport"""
+        viewport = self.parentWidget()
+        rect = QRect(-self.pos(), viewport.size()) if viewport is not None else self.rect()
+        return rect.intersected(self.slide_rect())
+
+    def request_tiles(self):
+        """Ask the worker for the visible tiles that are not cached yet"""
+        area = self.visible_rect()
+        if area.isEmpty():
+            return
+        size = self.tile_size
+        missing = QRect()
+        for ty in range(area.top() // size, area.bottom() // size + 1):
+            for tx in range(area.left() // size, area.right() // size + 1):
+                if self.cached_tile(tx, ty) is None:
+                    rect = QRect(tx * size, ty * size, size, size).intersected(self.slide_rect())
+                    if self.layout.single_image:
+                        missing = missing.united(rect)
+                    else:
+                        self.worker.tile(self, self.slides, self.index, self.layout, (tx, ty), rect)
+        if not missing.isEmpty():
+            # one decode of the picture covers all the missing tiles
+            self.worker.tile(self, self.slides, self.index, self.layout, rect=missing, tile_size=size)
+
+    def cached_tile(self, tx: int, ty: int) -> QPixmap | None:
+        key = (id(self.layout), tx, ty)
+        entry = self.tiles.get(key)
+        if entry is None or entry[0] is not self.layout:
+            return None
+        self.tiles.move_to_end(key)
+        return entry[1]
+
+    def _on_tiled(self, owner, layout: SlideLayout, tile: tuple[int, int], image: QImage):
+        if owner is not self or layout is not self.layout:
+            return
+        self.tiles[(id(layout), *tile)] = (layout, QPixmap.fromImage(image))
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        size = self.tile_size
+        self.update(tile[0] * size, tile[1] * size, size, size)
+
+    def paintEvent(self, event):
+        area = event.rect().intersected(self.slide_rect())
+        if area.isEmpty():
+            return
+        painter = QPainter(self)
+        size = self.tile_size
+        for ty in range(area.top() // size, area.bottom() // size + 1):
+            for tx in range(area.left() // size, area.right() // size + 1):
+                pixmap = self.cached_tile(tx, ty)
+                if pixmap is None:
+                    painter.fillRect(QRect(tx * size, ty * size, size, size).intersected(area), PLACEHOLDER_COLOR)
+                else:
+                    painter.drawPixmap(tx * size, ty * size, pixmap)
+        if self.hasFocus() and self.focus_index != -1:
+            painter.setPen(QPen(FOCUS_COLOR, 2))
+            painter.drawRect(self.objects[self.focus_index].rect.adjusted(1, 1, -1, -1))
+
+    def moveEvent(self, event):
+        # scrolling the surrounding QScrollArea moves this widget
+        super().moveEvent(event)
+        self.request_tiles()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.request_tiles()
+
+    def set_focus_index(self, index: int):
+        if index == self.focus_index:
+            return
+        for i in (self.focus_index, index):
+            if i != -1:
+                self.update(self.objects[i].rect)
+        self.focus_index = index
+        if index != -1:
+            scroll_area = self.parentWidget().parentWidget() if self.parentWidget() else None
+            if isinstance(scroll_area, QScrollArea):
+                rect = self.objects[index].rect
+                scroll_area.ensureVisible(rect.center().x(), rect.center().y(), rect.width() // 2, rect.height() // 2)
+
+    def focused_data(self, obj_type: str):
+        if self.focus_index == -1:
+            return None
+        data = self.objects[self.focus_index].data
+        return data if data.type == obj_type else None
+
+    def focusNextPrevChild(self, next: bool) -> bool:
+        index = self.focus_index + (1 if next else -1)
+        if not self.hasFocus() or not (0 <= index < len(self.objects)):
+            return super().focusNextPrevChild(next)
+        self.set_focus_index(index)
+        return True
 
     def focusInEvent(self, event):
-        self._set_shortcuts_enabled(True)
+        if self.focus_index == -1 and self.objects:
+            reason = event.reason()
+            if reason == Qt.FocusReason.TabFocusReason:
+                self.set_focus_index(0)
+            elif reason == Qt.FocusReason.BacktabFocusReason:
+                self.set_focus_index(len(self.objects) - 1)
+        self.update()
         super().focusInEvent(event)
 
     def focusOutEvent(self, event):
-        self._set_shortcuts_enabled(False)
+        self.update()
         super().focusOutEvent(event)
 
-    def _set_shortcuts_enabled(self, enabled: bool):
-        self.shortcut_open.setEnabled(enabled)
-        self.shortcut_copy.setEnabled(enabled)
-        self.shortcut_save.setEnabled(enabled)
+    def event(self, event):
+        if event.type() == QEvent.Type.ToolTip:
+            index = self.hit_index.at(event.pos())
+            if index == -1:
+                QToolTip.hideText()
+                event.ignore()
+            else:
+                QToolTip.showText(event.globalPos(), self.tooltip(self.objects[index].data), self,
+                                  self.objects[index].rect)
+            return True
+        return super().event(event)
+
+    @staticmethod
+    def tooltip(data) -> str:
+        if data.type == 'Text':
+            return (f'Text Block\n'
+                    f'- Double-click or Ctrl+Enter to open\n'
+                    f'- Ctrl+C to copy\n'
+                    f'"{data.value}"')
+        return (f'{data.value} Block\n'
+                f'- Double-click or Ctrl+Enter to open\n'
+                f'- Ctrl+S to save')
+
+    def mousePressEvent(self, event: QMouseEvent):
+        self.set_focus_index(self.hit_index.at(event.position().toPoint()))
+        super().mousePressEvent(event)
 
     def mouseDoubleClickEvent(self, event: QMouseEvent):
-        if event.button() == Qt.MouseButton.LeftButton:
+        if event.button() == Qt.MouseButton.LeftButton and self.hit_index.at(event.position().toPoint()) != -1:
             self.do_default_action()
         super().mouseDoubleClickEvent(event)
 
-    def show_context_menu(self, pos: QPoint):
+    def contextMenuEvent(self, event):
+        index = self.hit_index.at(event.pos())
+        if index == -1:
+            return
+        self.set_focus_index(index)
+        data = self.objects[index].data
         menu = QMenu(self)
-        obj_type = self.obj_data['data']['type']
 
-        if obj_type == 'Text':
+        if data.type == 'Text':
             view_action = QAction("&Open Text...", self)
             view_action.setShortcut("Ctrl+Enter")
-            view_action.triggered.connect(lambda: self.view_text_content(self.obj_data['data']))
+            view_action.triggered.connect(lambda: self.view_text_content(data))
             menu.addAction(view_action)
 
             copy_action = QAction("&Copy Text", self)
             copy_action.setShortcut("Ctrl+C")
-            copy_action.triggered.connect(lambda: self.copy_text(self.obj_data['data']))
+            copy_action.triggered.connect(lambda: self.copy_text(data))
             menu.addAction(copy_action)
 
-        elif obj_type == 'Image':
+        elif data.type == 'Image':
             show_action = QAction("&Open Image", self)
             show_action.setShortcut("Ctrl+Enter")
-            show_action.triggered.connect(lambda: self.show_image(self.obj_data['data']))
+            show_action.triggered.connect(lambda: self.show_image(data))
             menu.addAction(show_action)
 
             save_as_action = QAction("&Save Image As...", self)
             save_as_action.setShortcut("Ctrl+S")
-            save_as_action.triggered.connect(lambda: self.save_image_as(self.obj_data['data']))
+            save_as_action.triggered.connect(lambda: self.save_image_as(data))
             menu.addAction(save_as_action)
 
-        menu.exec(self.mapToGlobal(pos))
+        menu.exec(event.globalPos())
 
     def do_default_action(self):
-        obj_type = self.obj_data['data']['type']
-        if obj_type == 'Text':
-            self.view_text_content(self.obj_data['data'])
-        elif obj_type == 'Image':
-            self.show_image(self.obj_data['data'])
+        if self.focus_index == -1:
+            return
+        data = self.objects[self.focus_index].data
+        if data.type == 'Text':
+            self.view_text_content(data)
+        elif data.type == 'Image':
+            self.show_image(data)
 
     def view_text_content(self, text_data):
-        dialog = TextViewerDialog(text_data['value'], self)
+        dialog = TextViewerDialog(text_data.value, self)
         dialog.exec()
 
     def copy_text(self, text_data):
-        QApplication.clipboard().setText(text_data['value'])
+        if text_data is None:
+            return
+        QApplication.clipboard().setText(text_data.value)
         if hasattr(self.window(), 'statusBar'):
             self.window().statusBar().showMessage("Text copied to clipboard", 2000)
 
     def show_image(self, image_data):
         try:
-            Image.open(image_data['file']).show()
+            open_image(image_data).show()
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Could not open image:\n{e}")
 
     def save_image_as(self, image_data):
-        source_path = image_data['file']
-        filename = os.path.basename(source_path)
+        if image_data is None:
+            return
+        filename = image_data.name
         path, _ = QFileDialog.getSaveFileName(
             self, "Save Image As...", filename, "Images (*.png *.jpg);;All Files (*)"
         )
         if path:
             try:
-                shutil.copy(source_path, path)
+                if image_data.asset is not None:
+                    image_data.asset.save(path)
+                else:
+                    shutil.copy(image_data.file, path)
                 QMessageBox.information(self, "Success", f"Image saved to:\n{path}")
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Could not save image:\n{e}")
 
 
-class SlideViewer(QWidget):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.background_label = QLabel(self)
-        self.background_label.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
-        self.background_label.move(0, 0)
-        self.overlay_widgets = []
+class ContinuousView(QAbstractScrollArea):
+    """All slides stacked vertically, like a PDF reader. Only the slides near the viewport are laid out
+    and painted; the others take a placeholder height until their layout arrives from the worker.
+    Tiles are painted on the worker and live in a bounded LRU cache. Layouts and tiles are requested
+    whenever the view scrolls or is laid out again; painting only draws what has arrived."""
+    current_changed = Signal(int)
 
-    def set_slide(self, pil_image: Image, objects: list):
-        for widget in self.overlay_widgets:
-            widget.deleteLater()
-        self.overlay_widgets.clear()
+    def __init__(self, worker: RenderWorker, parent=None, tile_size: int = TILE_SIZE,
+                 max_tiles: int = CONTINUOUS_MAX_TILES):
+        super().__init__(parent)
+        self.worker = worker
+        self.worker.signals.laid_out.connect(self._on_laid_out)
+        self.worker.signals.tiled.connect(self._on_tiled)
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.slides = SlideCache()
+        self.tops: list[int] = [0]
+        self.width_max = 0
+        self.placeholder = EMPTY_SLIDE_SIZE
+        self.current_index = -1
+        self.focus_index = -1
+        self.tiles: OrderedDict[tuple[int, int, int], tuple[SlideLayout, QPixmap]] = OrderedDict()
+        self.relayout_timer = QTimer(self)
+        self.relayout_timer.setSingleShot(True)
+        self.relayout_timer.setInterval(0)
+        self.relayout_timer.timeout.connect(self.relayout)
+        self.viewport().setAutoFillBackground(True)
+        self.verticalScrollBar().setSingleStep(SLIDE_GAP * 2)
+
+    def set_slides(self, slides: SlideCache):
+        self.slides = slides
+        self.tiles.clear()
+        self.current_index = self.focus_index = -1
+        self.relayout()
+        self.verticalScrollBar().setValue(0)
+
+    def slide_size(self, index: int) -> tuple[int, int]:
+        return self.slides.sizes.get(index, self.placeholder)
+
+    def schedule_relayout(self):
+        """Relayout once control returns to the event loop, however many pages or layouts arrived meanwhile"""
+        self.relayout_timer.start()
+
+    def relayout(self):
+        """Recompute slide positions, keeping the slide at the top of the viewport in place.
+        Slides without a layout yet take the average size of the ones laid out so far."""
+        scroll = self.verticalScrollBar()
+        anchor = self.index_at(scroll.value())
+        anchor_offset = scroll.value() - self.tops[anchor] if anchor != -1 else 0
+
+        known = list(self.slides.sizes.values())
+        if known:
+            self.placeholder = (sum(width for width, _ in known) // len(known),
+                                sum(height for _, height in known) // len(known))
+        else:
+            self.placeholder = EMPTY_SLIDE_SIZE
+
+        tops, top, width_max = [], 0, 0
+        for index in range(len(self.slides)):
+            width, height = self.slide_size(index)
+            tops.append(top)
+            top += height + SLIDE_GAP
+            width_max = max(width_max, width)
+        tops.append(top)
+        self.tops, self.width_max = tops, width_max
+
+        viewport = self.viewport().size()
+        scroll.setRange(0, max(top - SLIDE_GAP - viewport.height(), 0))
+        scroll.setPageStep(viewport.height())
+        self.horizontalScrollBar().setRange(0, max(width_max - viewport.width(), 0))
+        self.horizontalScrollBar().setPageStep(viewport.width())
+        if anchor != -1 and anchor < len(self.slides):
+            scroll.setValue(self.tops[anchor] + anchor_offset)
+        self.viewport().update()
+        self.request_visible()
+
+    def index_at(self, y: int) -> int:
+        if len(self.tops) < 2:
+            return -1
+        return min(max(bisect_right(self.tops, y) - 1, 0), len(self.tops) - 2)
+
+    def scroll_to(self, index: int):
+        if 0 <= index < len(self.tops) - 1:
+            self.verticalScrollBar().setValue(self.tops[index])
+
+    def slide_rect(self, index: int) -> QRect:
+        """Where slide `index` is on the viewport"""
+        width, height = self.slide_size(index)
+        x = (max(self.viewport().width(), self.width_max) - width) // 2 - self.horizontalScrollBar().value()
+        return QRect(x, self.tops[index] - self.verticalScrollBar().value(), width, height)
+
+    def visible_slides(self) -> range:
+        y = self.verticalScrollBar().value()
+        return range(self.index_at(y), self.index_at(y + self.viewport().height() - 1) + 1)
+
+    def request_visible(self):
+        """Ask the worker for the layouts of the slides on and around the screen, and for the tiles
+        of the visible slides that are not cached yet"""
+        if len(self.tops) < 2 or not self.isVisible():
+            return
+        visible = self.visible_slides()
+        middle = (visible.start + visible.stop - 1) // 2
+        if middle != self.focus_index:
+            self.focus_index = middle
+            self.worker.focus(self.slides, middle)
+        for index in visible:
+            if self.slides.peek_layout(index) is None:
+                self.worker.request(self.slides, index, CURRENT_SLIDE_PRIORITY, layout=True)
+        for distance in range(1, self.worker.radius + 1):
+            for index in (visible.start - distance, visible.stop - 1 + distance):
+                if 0 <= index < len(self.slides) and self.slides.peek_layout(index) is None:
+                    self.worker.request(self.slides, index, PREFETCH_PRIORITY, layout=True)
+
+        layouts, size = [], self.tile_size
+        for index in visible:
+            layout = self.slides.peek_layout(index)
+            if layout is None:
+                continue
+            layouts.append(layout)
+            rect = self.slide_rect(index)
+            area = rect.intersected(self.viewport().rect()).translated(-rect.topLeft())
+            for ty in range(area.top() // size, area.bottom() // size + 1):
+                for tx in range(area.left() // size, area.right() // size + 1):
+                    if self.cached_tile(index, layout, tx, ty) is None:
+                        tile_rect = QRect(tx * size, ty * size, size, size).intersected(
+                            QRect(0, 0, layout.width, layout.height))
+                        self.worker.tile(self, self.slides, index, layout, (index, tx, ty), tile_rect)
+        self.worker.show_tiles(self, layouts)
+
+    def paintEvent(self, event):
+        if len(self.tops) < 2:
+            return
+        painter = QPainter(self.viewport())
+        area = event.rect()
+        y = self.verticalScrollBar().value()
+        for index in range(self.index_at(y + area.top()), self.index_at(y + area.bottom()) + 1):
+            rect = self.slide_rect(index)
+            visible = rect.intersected(area)
+            if visible.isEmpty():
+                continue
+            layout = self.slides.peek_layout(index)
+            if layout is None:
+                painter.fillRect(visible, PLACEHOLDER_COLOR)
+                continue
+            visible.translate(-rect.topLeft())
+            size = self.tile_size
+            for ty in range(visible.top() // size, visible.bottom() // size + 1):
+                for tx in range(visible.left() // size, visible.right() // size + 1):
+                    pixmap = self.cached_tile(index, layout, tx, ty)
+                    tile_rect = QRect(rect.left() + tx * size, rect.top() + ty * size, size, size)
+                    if pixmap is None:
+                        painter.fillRect(tile_rect.intersected(rect).intersected(area), PLACEHOLDER_COLOR)
+                    else:
+                        painter.drawPixmap(tile_rect.topLeft(), pixmap)
+
+    def cached_tile(self, index: int, layout: SlideLayout, tx: int, ty: int) -> QPixmap | None:
+        key = (index, tx, ty)
+        entry = self.tiles.get(key)
+        if entry is None or entry[0] is not layout:
+            return None
+        self.tiles.move_to_end(key)
+        return entry[1]
+
+    def _on_tiled(self, owner, layout: SlideLayout, tile: tuple[int, int, int], image: QImage):
+        if owner is not self or not self.worker.tile_wanted(self, layout):
+            return
+        self.tiles[tile] = (layout, QPixmap.fromImage(image))
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        index, tx, ty = tile
+        if index < len(self.tops) - 1:
+            rect = self.slide_rect(index)
+            size = self.tile_size
+            self.viewport().update(QRect(rect.left() + tx * size, rect.top() + ty * size, size, size))
+
+    def _on_laid_out(self, slides: SlideCache, index: int, layout):
+        if slides is self.slides and self.isVisible():
+            self.schedule_relayout()
+
+    def scrollContentsBy(self, dx: int, dy: int):
+        self.viewport().update()
+        self.request_visible()
+        index = self.index_at(self.verticalScrollBar().value())
+        if index != self.current_index:
+            self.current_index = index
+            self.current_changed.emit(index)
 
-        qim = ImageQt(pil_image.convert("RGBA"))
-        pixmap = QPixmap.fromImage(qim)
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.relayout()
 
-        self.background_label.setPixmap(pixmap)
-        self.background_label.adjustSize()
 
-        for obj in objects:
-            overlay = InteractiveObjectWidget(obj, self.background_label)
-            overlay.setGeometry(obj['rect'])
-            overlay.show()
-            self.overlay_widgets.append(overlay)
+class ThumbnailModel(QAbstractListModel):
+    """Slide numbers with their thumbnails. A thumbnail comes from memory or the thumbnail cache,
+    and is only painted by the worker when a view asks for it, i.e. when its row is on screen."""
 
-        self.setMinimumSize(self.background_label.size())
-        self.updateGeometry()
+    def __init__(self, worker: RenderWorker, thumbnails: ThumbnailCache | None = None, size: int = THUMBNAIL_SIZE,
+                 max_pixmaps: int = THUMBNAIL_MAX_PIXMAPS, parent=None):
+        super().__init__(parent)
+        self.worker = worker
+        self.worker.signals.thumbnailed.connect(self._on_thumbnailed)
+        self.thumbnails = thumbnails
+        self.size = size
+        self.max_pixmaps = max_pixmaps
+        self.slides = SlideCache()
+        self.document: str | None = None
+        self.count = 0
+        self.pixmaps: OrderedDict[int, QPixmap] = OrderedDict()
+        self.default_placeholder = QPixmap(size, size * 3 // 4)
+        self.default_placeholder.fill(PLACEHOLDER_COLOR)
+
+    def set_slides(self, slides: SlideCache, document: str | None = None):
+        self.beginResetModel()
+        self.slides, self.document = slides, document
+        self.count = len(slides)
+        self.pixmaps.clear()
+        self.endResetModel()
+
+    def pages_added(self):
+        if self.count < len(self.slides):
+            self.beginInsertRows(QModelIndex(), self.count, len(self.slides) - 1)
+            self.count = len(self.slides)
+            self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else self.count
+
+    def data(self, index: QModelIndex, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return str(index.row() + 1)
+        if role == Qt.ItemDataRole.DecorationRole:
+            return self.thumbnail(index.row())
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return f"Slide {index.row() + 1}"
+        return None
+
+    def thumbnail(self, row: int) -> QPixmap:
+        pixmap = self.pixmaps.get(row)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(row)
+            return pixmap
+        if self.thumbnails is not None and self.document is not None:
+            image = self.thumbnails.load(self.document, row, self.size)
+            if image is not None:
+                return self._remember(row, QPixmap.fromImage(image))
+        self.worker.thumbnail(self.slides, row, self.size, self.thumbnails, self.document)
+        return self.placeholder(row)
+
+    def placeholder(self, row: int) -> QPixmap:
+        """Blank thumbnail in the shape of the slide once its size is known (also from an earlier session)"""
+        size = self.slides.sizes.get(row)
+        if size is None:
+            return self.default_placeholder
+        scale = min(self.size / size[0], self.size / size[1], 1)
+        pixmap = QPixmap(max(round(size[0] * scale), 1), max(round(size[1] * scale), 1))
+        pixmap.fill(PLACEHOLDER_COLOR)
+        return pixmap
+
+    def _remember(self, row: int, pixmap: QPixmap) -> QPixmap:
+        self.pixmaps[row] = pixmap
+        while len(self.pixmaps) > self.max_pixmaps:
+            self.pixmaps.popitem(last=False)
+        return pixmap
+
+    def _on_thumbnailed(self, slides: SlideCache, index: int, image: QImage):
+        if slides is self.slides and index < self.count:
+            self._remember(index, QPixmap.fromImage(image))
+            model_index = self.index(index)
+            self.dataChanged.emit(model_index, model_index, [Qt.ItemDataRole.DecorationRole])
+
+
+class ThumbnailList(QListView):
+    """Vertical strip of slide thumbnails; tells the worker which rows are on screen so that
+    thumbnails queued for rows scrolled past are skipped"""
+
+    def __init__(self, model: ThumbnailModel, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setViewMode(QListView.ViewMode.IconMode)
+        self.setFlow(QListView.Flow.TopToBottom)
+        self.setWrapping(False)
+        self.setMovement(QListView.Movement.Static)
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setUniformItemSizes(True)
+        self.setIconSize(QSize(model.size, model.size))
+        self.setSpacing(4)
+        self.setFixedWidth(model.size + 2 * self.frameWidth() + self.verticalScrollBar().sizeHint().width() + 16)
+
+    def update_visible_rows(self):
+        model = self.model()
+        first = self.indexAt(QPoint(self.viewport().width() // 2, 0)).row()
+        last = self.indexAt(QPoint(self.viewport().width() // 2, self.viewport().height() - 1)).row()
+        last = model.count - 1 if last == -1 else last
+        model.worker.show_thumbnails(model.slides, range(max(first, 0), last + 1))
+
+    def paintEvent(self, event):
+        # the rows painted now are the ones whose thumbnails data() is about to request
+        self.update_visible_rows()
+        super().paintEvent(event)
 
 
 class PresentationWindow(QWidget):
-    def __init__(self, slides_data, parent=None):
+    """Full-screen slides from a cache of screen-sized pixmaps keyed by (slide, size).
+    The slides next to the current one are scaled in the background; while the window is being resized
+    the shown pixmap is stretched quickly and replaced by smooth ones once the size settles."""
+
+    def __init__(self, slides: SlideCache, worker: RenderWorker, parent=None,
+                 max_pixmaps: int = PRESENTATION_CACHE_MAX_PIXMAPS):
         super().__init__(parent)
-        self.slides_data = slides_data
+        self.slides = slides
+        self.worker = worker
+        self.worker.signals.scaled.connect(self._on_scaled)
         self.current_index = -1
-        self.current_pixmap = QPixmap()
+        self.max_pixmaps = max_pixmaps
+        self.pixmaps: OrderedDict[tuple[int, tuple[int, int]], QPixmap] = OrderedDict()
         self.slide_label = QLabel(self)
         self.slide_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.slide_label.setSizePolicy(QSizePolicy.Policy.Ignored, QSizePolicy.Policy.Ignored)
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(RESIZE_SETTLE_MS)
+        self.resize_timer.timeout.connect(self._update_display)
 
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
@@ -210,20 +679,36 @@ class PresentationWindow(QWidget):
         self.setWindowTitle("Presentation Mode")
         self.setStyleSheet("background-color: black;")
 
+    def target_size(self) -> tuple[int, int]:
+        return self.slide_label.width(), self.slide_label.height()
+
     def go_to_slide(self, index):
-        if not (0 <= index < len(self.slides_data)): return
-        if self.current_index != index:
-            self.current_index = index
-            pil_image = self.slides_data[self.current_index]['image']
-            qim = ImageQt(pil_image.convert("RGBA"))
-            self.current_pixmap = QPixmap.fromImage(qim)
+        if not (0 <= index < len(self.slides)): return
+        self.current_index = index
         self._update_display()
 
     def _update_display(self):
-        if self.current_pixmap.isNull(): return
-        scaled_pixmap = self.current_pixmap.scaled(
-            self.slide_label.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
-        self.slide_label.setPixmap(scaled_pixmap)
+        size = self.target_size()
+        if self.current_index < 0 or min(size) <= 0: return
+        pixmap = self.pixmaps.get((self.current_index, size))
+        if pixmap is not None:
+            self.pixmaps.move_to_end((self.current_index, size))
+            self.slide_label.setPixmap(pixmap)
+        self.worker.focus(self.slides, self.current_index)
+        for index in (self.current_index, self.current_index + 1, self.current_index - 1):
+            if (index, size) not in self.pixmaps:
+                self.worker.scale(self.slides, index, size,
+                                  CURRENT_SLIDE_PRIORITY if index == self.current_index else PREFETCH_PRIORITY)
+
+    def _on_scaled(self, slides: SlideCache, index: int, size: tuple[int, int], image: QImage):
+        if slides is not self.slides:
+            return
+        pixmap = QPixmap.fromImage(image)
+        self.pixmaps[(index, size)] = pixmap
+        while len(self.pixmaps) > self.max_pixmaps:
+            self.pixmaps.popitem(last=False)
+        if index == self.current_index and size == self.target_size():
+            self.slide_label.setPixmap(pixmap)
 
     def keyPressEvent(self, event):
         key = event.key()
@@ -234,6 +719,16 @@ class PresentationWindow(QWidget):
         elif key == Qt.Key.Key_Escape:
             self.close()
 
+    def closeEvent(self, event):
+        self.resize_timer.stop()
+        self.worker.signals.scaled.disconnect(self._on_scaled)
+        self.pixmaps.clear()
+        super().closeEvent(event)
+
     def resizeEvent(self, event):
         super().resizeEvent(event)
-        self._update_display()
+        shown = self.slide_label.pixmap()
+        if not shown.isNull():
+            self.slide_label.setPixmap(shown.scaled(
+                self.slide_label.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.FastTransformation))
+        self.resize_timer.start()
@@ -0,0 +1,322 @@
+__author__ = 'Nikita Denissov'
+
+from pathlib import Path
+from typing import Iterator
+
+from PIL.ImageQt import ImageQt
+from PySide6.QtCore import QObject, QRect, QRunnable, QSize, QThreadPool, Qt, Signal
+from PySide6.QtGui import QImage
+
+from .cache import ParseCache, content_key
+from .image_cache import ThumbnailCache
+from .model import Page
+from .parser import NatDocument, iter_processed_pages, load_extracted, parse_page
+from .layout import SlideLayout
+from .qt_renderer import load_qimage, paint_layout_region, paint_thumbnail
+from .renderer import SlideCache
+
+PREFETCH_RADIUS = 2
+CURRENT_SLIDE_PRIORITY = 1
+PREFETCH_PRIORITY = 0
+
+
+def iter_file_pages(file_path: Path, cache: ParseCache | None = None, key: str | None = None) -> Iterator[Page]:
+    if file_path.suffix in ('.json', '.ndjson'):
+        yield from load_extracted(file_path).pages
+    else:
+        yield from iter_processed_pages(file_path, None, cache, key)
+
+
+class WorkerSignals(QObject):
+    page_jumped = Signal(object, object, int)
+    page_parsed = Signal(object, object)
+    parsed = Signal(object)
+    failed = Signal(object, object)
+    rendered = Signal(object, int, object)
+    laid_out = Signal(object, int, object)
+    scaled = Signal(object, int, object, object)
+    thumbnailed = Signal(object, int, object)
+    tiled = Signal(object, object, object, object)
+
+
+class ParseTask(QRunnable):
+    """Streams the pages of a file; with a thumbnail cache the document key is set before the first page.
+    The file is hashed at most once: the parse cache key doubles as the thumbnail document key.
+    When `page` is past the first one and the parse cache holds the page index of the file, that page is
+    parsed on its own and delivered through `page_jumped` before the sequential parse starts.
+    Slide layouts stored for the document by an earlier session are in `layouts` before the first page."""
+
+    def __init__(self, file_path: Path, cache: ParseCache | None, signals: WorkerSignals,
+                 thumbnails: ThumbnailCache | None = None, page: int = 1):
+        super().__init__()
+        self.file_path = file_path
+        self.cache = cache
+        self.signals = signals
+        self.thumbnails = thumbnails
+        self.page = page
+        self.key: str | None = None
+        self.document: str | None = None
+        self.layouts = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            key = None
+            if self.cache is not None:
+                key = self.cache.key(self.file_path)
+            elif self.thumbnails is not None:
+                key = content_key(self.file_path)
+            self.key = key
+            self.document = key if self.thumbnails is not None else None
+            if self.cache is not None:
+                self.layouts = self.cache.load_layouts(key)
+            if self.page > 1 and self.cache is not None and self.file_path.suffix == '.nat':
+                self.jump(key)
+            for page in iter_file_pages(self.file_path, self.cache, key):
+                if self.cancelled:
+                    return
+                self.signals.page_parsed.emit(self, page)
+        except Exception as e:
+            self.signals.failed.emit(self, e)
+        else:
+            self.signals.parsed.emit(self)
+
+    def jump(self, key: str):
+        index = self.cache.load_index(key)
+        if index is not None and self.page <= len(index):
+            document = NatDocument(self.file_path, index)
+            self.signals.page_jumped.emit(self, parse_page(document, self.page), document.page_count)
+
+
+class RenderTask(QRunnable):
+    """Renders a slide, or computes only its layout, or renders it and scales it to fit `size`"""
+
+    def __init__(self, worker: 'RenderWorker', slides: SlideCache, index: int, priority: int, layout: bool = False,
+                 size: tuple[int, int] | None = None):
+        super().__init__()
+        self.worker = worker
+        self.slides = slides
+        self.index = index
+        self.priority = priority
+        self.layout = layout
+        self.size = size
+
+    @property
+    def key(self) -> tuple:
+        return self.slides, self.index, self.layout, self.size
+
+    def run(self):
+        signals = self.worker.signals
+        try:
+            if self.priority <= PREFETCH_PRIORITY and not self.worker.wanted(self.slides, self.index):
+                return
+            if self.layout:
+                signals.laid_out.emit(self.slides, self.index, self.slides.layout(self.index))
+            elif self.size is not None:
+                image = self.slides.get(self.index).image
+                if not isinstance(image, QImage):
+                    image = ImageQt(image.convert("RGBA"))
+                image = image.scaled(QSize(*self.size), Qt.AspectRatioMode.KeepAspectRatio,
+                                     Qt.TransformationMode.SmoothTransformation)
+                signals.scaled.emit(self.slides, self.index, self.size, image)
+            else:
+                signals.rendered.emit(self.slides, self.index, self.slides.get(self.index))
+        except Exception as e:
+            signals.failed.emit(self, e)
+        finally:
+            self.worker.pending.pop(self.key, None)
+
+
+class ThumbnailTask(QRunnable):
+    """Paints a slide thumbnail from its layout and stores it in the thumbnail cache"""
+
+    def __init__(self, worker: 'RenderWorker', slides: SlideCache, index: int, size: int,
+                 thumbnails: ThumbnailCache | None = None, document: str | None = None):
+        super().__init__()
+        self.worker = worker
+        self.slides = slides
+        self.index = index
+        self.size = size
+        self.thumbnails = thumbnails
+        self.document = document
+        self.priority = PREFETCH_PRIORITY
+
+    @property
+    def key(self) -> tuple:
+        return self.slides, self.index, 'thumbnail', self.size
+
+    def run(self):
+        try:
+            if not self.worker.thumbnail_wanted(self.slides, self.index):
+                return
+            # fonts are not safe to use from several threads at once
+            with self.slides.render_lock:
+                image = paint_thumbnail(self.slides.pages[self.index], self.slides.layout(self.index), self.size)
+            if self.thumbnails is not None and self.document is not None:
+                self.thumbnails.store(self.document, self.index, self.size, image)
+            self.worker.signals.thumbnailed.emit(self.slides, self.index, image)
+        except Exception as e:
+            self.worker.signals.failed.emit(self, e)
+        finally:
+            self.worker.pending.pop(self.key, None)
+
+
+class TileTask(QRunnable):
+    """Paints one tile of a slide layout for the view `owner`; skipped once the owner has moved on to other layouts.
+
+    When `tile` is None the slide is a single picture: it is decoded once, clipped to `rect` and delivered cut
+    into the tiles of `tile_size` that `rect` covers; no view keeps the whole picture."""
+
+    def __init__(self, worker: 'RenderWorker', owner: QObject, slides: SlideCache, index: int, layout: SlideLayout,
+                 tile: tuple[int, int] | None = None, rect: QRect | None = None,
+                 priority: int = CURRENT_SLIDE_PRIORITY, tile_size: int = 0):
+        super().__init__()
+        self.worker = worker
+        self.owner = owner
+        self.slides = slides
+        self.index = index
+        self.layout = layout
+        self.tile = tile
+        self.rect = rect
+        self.priority = priority
+        self.tile_size = tile_size
+
+    @property
+    def key(self) -> tuple:
+        # the task holds on to its layout, so the id cannot be reused while the key is pending
+        return 'tile', id(self.owner), id(self.layout), self.tile if self.tile is not None else self.rect.getRect()
+
+    def run(self):
+        try:
+            if not self.worker.tile_wanted(self.owner, self.layout):
+                return
+            page = self.slides.pages[self.index]
+            if self.tile is None:
+                self.cut_picture(load_qimage(page.objects[0], clip=self.rect))
+                return
+            # fonts are not safe to use from several threads at once
+            with self.slides.render_lock:
+                image = paint_layout_region(page, self.layout, self.rect, self.slides.images)
+            self.worker.signals.tiled.emit(self.owner, self.layout, self.tile, image)
+        except Exception as e:
+            self.worker.signals.failed.emit(self, e)
+        finally:
+            self.worker.pending.pop(self.key, None)
+
+    def cut_picture(self, image: QImage):
+        size, rect = self.tile_size, self.rect
+        for ty in range(rect.top() // size, rect.bottom() // size + 1):
+            for tx in range(rect.left() // size, rect.right() // size + 1):
+                part = QRect(tx * size, ty * size, size, size).intersected(rect)
+                self.worker.signals.tiled.emit(self.owner, self.layout, (tx, ty),
+                                               image.copy(part.translated(-rect.topLeft())))
+
+
+class RenderWorker(QObject):
+    """Parses files and renders slides on a thread pool; results are delivered
+    to the GUI thread through `signals`"""
+
+    def __init__(self, parent=None, radius: int = PREFETCH_RADIUS):
+        super().__init__(parent)
+        self.radius = radius
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+        self.signals = WorkerSignals(self)
+        self.pending: dict[tuple, RenderTask | ThumbnailTask | TileTask] = {}
+        self.slides: SlideCache | None = None
+        self.center = -1
+        self.thumbnail_slides: SlideCache | None = None
+        self.thumbnail_rows = range(0)
+        self.tile_layouts: dict[QObject, tuple[SlideLayout, ...]] = {}
+
+    def parse(self, file_path: Path, cache: ParseCache | None = None,
+              thumbnails: ThumbnailCache | None = None, page: int = 1) -> ParseTask:
+        task = ParseTask(file_path, cache, self.signals, thumbnails, page)
+        self.pool.start(task, CURRENT_SLIDE_PRIORITY)
+        return task
+
+    def wanted(self, slides: SlideCache, index: int) -> bool:
+        return slides is self.slides and abs(index - self.center) <= self.radius
+
+    def request(self, slides: SlideCache, index: int, priority: int = CURRENT_SLIDE_PRIORITY, layout: bool = False):
+        """Deliver slide `index` through `rendered`, or only its layout through `laid_out`"""
+        if not (0 <= index < len(slides)):
+            return
+        if layout:
+            cached = slides.peek_layout(index)
+            if cached is not None:
+                self.signals.laid_out.emit(slides, index, cached)
+                return
+        else:
+            slide = slides.peek(index)
+            if slide is not None:
+                self.signals.rendered.emit(slides, index, slide)
+                return
+        self._start(RenderTask(self, slides, index, priority, layout))
+
+    def scale(self, slides: SlideCache, index: int, size: tuple[int, int], priority: int = CURRENT_SLIDE_PRIORITY):
+        """Deliver slide `index` smoothly scaled to fit `size` through `scaled`"""
+        if 0 <= index < len(slides):
+            self._start(RenderTask(self, slides, index, priority, size=size))
+
+    def thumbnail(self, slides: SlideCache, index: int, size: int, thumbnails: ThumbnailCache | None = None,
+                  document: str | None = None):
+        """Deliver a thumbnail of slide `index` through `thumbnailed`; skipped once the row scrolls out of view"""
+        if 0 <= index < len(slides):
+            self._start(ThumbnailTask(self, slides, index, size, thumbnails, document))
+
+    def thumbnail_wanted(self, slides: SlideCache, index: int) -> bool:
+        return slides is self.thumbnail_slides and index in self.thumbnail_rows
+
+    def show_thumbnails(self, slides: SlideCache, rows: range):
+        self.thumbnail_slides, self.thumbnail_rows = slides, rows
+
+    def tile(self, owner: QObject, slides: SlideCache, index: int, layout: SlideLayout,
+             tile: tuple[int, int] | None = None, rect: QRect | None = None, priority: int = CURRENT_SLIDE_PRIORITY,
+             tile_size: int = 0):
+        """Deliver tile `tile` (covering `rect`) of a slide layout through `tiled`; for a single-image slide,
+        with `tile` None, every tile of `tile_size` within `rect` is delivered from one decode"""
+        self._start(TileTask(self, owner, slides, index, layout, tile, rect, priority, tile_size))
+
+    def tile_wanted(self, owner: QObject, layout: SlideLayout) -> bool:
+        return any(layout is wanted for wanted in self.tile_layouts.get(owner, ()))
+
+    def show_tiles(self, owner: QObject, layouts: list[SlideLayout]):
+        """The layouts `owner` currently shows; queued tiles of any other layout are skipped"""
+        self.tile_layouts[owner] = tuple(layouts)
+
+    def focus(self, slides: SlideCache, index: int):
+        self.slides, self.center = slides, index
+
+    def _start(self, task: RenderTask | ThumbnailTask | TileTask):
+        queued = self.pending.get(task.key)
+        if queued is None:
+            self.pending[task.key] = task
+            self.pool.start(task, task.priority)
+        elif task.priority > queued.priority and self.pool.tryTake(queued):
+            # a prefetch that became the current slide moves ahead instead of being rendered twice
+            queued.priority = task.priority
+            self.pool.start(queued, queued.priority)
+
+    def page_added(self, slides: SlideCache, index: int, layout: bool = False):
+        if self.wanted(slides, index):
+            self.request(slides, index, PREFETCH_PRIORITY, layout)
+
+    def show(self, slides: SlideCache, index: int, layout: bool = False):
+        """Renders slide `index` ahead of everything else, then the slides around it;
+        queued prefetches that fell out of range are skipped"""
+        self.focus(slides, index)
+        self.request(slides, index, CURRENT_SLIDE_PRIORITY, layout)
+        for distance in range(1, self.radius + 1):
+            self.request(slides, index + distance, PREFETCH_PRIORITY, layout)
+            self.request(slides, index - distance, PREFETCH_PRIORITY, layout)
+
+    def shutdown(self):
+        self.slides = None
+        self.thumbnail_slides = None
+        self.tile_layouts.clear()
+        self.pool.clear()
+        self.pool.waitForDone()
@@ -0,0 +1,44 @@
+import io
+import struct
+import zlib
+
+import pytest
+from PIL import Image
+
+PAGE_BREAK = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+
+def png(width: int = 8, height: int = 6, color=(200, 30, 30)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def text(value: str) -> bytes:
+    encoded = value.encode()
+    return struct.pack('<I', len(encoded)) + encoded + b'<\0'
+
+
+def nat_body(page_count: int) -> bytes:
+    """Pages of a title, two pictures (the second shared by every page) and a footer"""
+    pages = []
+    for number in range(1, page_count + 1):
+        pages.append(text(f'Title {number}') + b'\0' + png(color=(number * 20 % 256, 100, 50)) + b'\0'
+                     + png(color=(0, 0, 255)) + b'\0' + text(f'Footer of page {number}'))
+    return PAGE_BREAK.join(pages)
+
+
+def nat_file_bytes(body: bytes, compress: bool = True) -> bytes:
+    return b'NAT' + b'\0' * 10 + (zlib.compress(body) if compress else body)
+
+
+@pytest.fixture
+def make_nat(tmp_path):
+    """Write a .nat file of page_count pages, or of the given decompressed body"""
+
+    def make(name: str = 'doc.nat', page_count: int = 3, body: bytes | None = None, compress: bool = True):
+        path = tmp_path / name
+        path.write_bytes(nat_file_bytes(nat_body(page_count) if body is None else body, compress))
+        return path
+
+    return make
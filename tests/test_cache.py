@@ -0,0 +1,41 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from notateit_viewer.cache import ParseCache
+from notateit_viewer.extractor import extract_file
+
+
+def read_images(output_path: Path) -> list[bytes]:
+    """Bytes of every image an extraction result points at, in document order"""
+    with open(output_path) as file:
+        pages = json.load(file)['pages']
+    images = []
+    for page in pages:
+        for obj in page['objects']:
+            if 'bundle' in obj:
+                with open(obj['bundle'], 'rb') as bundle:
+                    bundle.seek(obj['offset'])
+                    images.append(bundle.read(obj['length']))
+            elif 'file' in obj:
+                images.append(Path(obj['file']).read_bytes())
+    return images
+
+
+@pytest.mark.parametrize('store_assets', [False, True])
+@pytest.mark.parametrize('options', [{}, {'dedup': True}, {'bundle': True}, {'bundle': True, 'dedup': True}])
+def test_cache_hit_matches_miss_after_plain_extraction(make_nat, tmp_path, store_assets, options):
+    nat = make_nat(page_count=3)
+    cache = ParseCache(tmp_path / 'cache', store_assets=store_assets)
+    plain = extract_file(nat, tmp_path / 'out', False, cache)
+    expected = read_images(plain.output_path)
+
+    result = extract_file(nat, tmp_path / 'out', False, cache, **options)
+    assert read_images(result.output_path) == expected
+    with open(result.output_path) as file:
+        objects = [obj for page in json.load(file)['pages'] for obj in page['objects'] if obj['type'] == 'Image']
+    assert all(('bundle' in obj) == bool(options.get('bundle')) for obj in objects)
+    if options.get('dedup'):
+        # the picture shared by every page is stored once
+        assert result.bytes_saved == 2 * len(expected[1])
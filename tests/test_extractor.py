@@ -0,0 +1,90 @@
+import io
+import json
+from pathlib import Path
+
+import pytest
+
+from notateit_viewer.cache import ParseCache
+from notateit_viewer.extractor import JsonPageWriter, extract_batch, extract_file
+from notateit_viewer.model import Document, ImageObject, Page, TextObject
+from notateit_viewer.parser import PNG_SIGNATURE, load_extracted
+
+
+def make_document(page_count: int) -> Document:
+    pages = []
+    for number in range(1, page_count + 1):
+        pages.append(Page(number, [TextObject(f"Title {number} é\"\\"),
+                                   ImageObject(number, 1, file=f"out/page{number}_img1.png"),
+                                   ImageObject(number, 2, bundle="out/doc.natpack", offset=8, length=42)]))
+    return Document(pages)
+
+
+def write_document(document: Document, **options) -> str:
+    output = io.StringIO()
+    writer = JsonPageWriter(output, **options)
+    for page in document.pages:
+        writer.write(page)
+    writer.close()
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('page_count', [0, 1, 2])
+def test_indented_output_matches_json_dumps(page_count):
+    document = make_document(page_count)
+    assert write_document(document) == json.dumps(document.to_json(), indent=1)
+
+
+@pytest.mark.parametrize('page_count', [0, 1, 2])
+def test_minimized_output_matches_json_dumps(page_count):
+    document = make_document(page_count)
+    assert write_document(document, minimize=True) == json.dumps(document.to_json(), separators=(',', ':'))
+
+
+@pytest.mark.parametrize('page_count', [0, 1, 2])
+def test_ndjson_writes_one_compact_page_per_line(page_count):
+    document = make_document(page_count)
+    expected = ''.join(json.dumps(page.to_json(), separators=(',', ':')) + '\n' for page in document.pages)
+    assert write_document(document, ndjson=True) == expected
+
+
+def test_batch_extraction_with_parse_cache(make_nat, tmp_path):
+    files = [make_nat(f'doc{n}.nat', page_count=n) for n in (1, 2, 3)]
+    cache = ParseCache(tmp_path / 'cache')
+    for _ in range(2):
+        assert extract_batch(files, tmp_path / 'out', False, jobs=2, cache=cache) == 0
+    for n, file in enumerate(files, 1):
+        with open(tmp_path / 'out' / file.stem / f'{file.stem}.json') as output:
+            pages = json.load(output)['pages']
+        assert [page['page_number'] for page in pages] == list(range(1, n + 1))
+        assert all(Path(obj['file']).is_file() for page in pages for obj in page['objects'] if 'file' in obj)
+    assert list((tmp_path / 'cache').glob('*.natc'))
+
+
+def test_load_extracted_maps_bundled_images(make_nat, tmp_path):
+    result = extract_file(make_nat(page_count=2), tmp_path / 'out', False, bundle=True, dedup=True)
+    document = load_extracted(result.output_path)
+    images = [obj for page in document.pages for obj in page.objects if obj.type == 'Image']
+    assert len(images) == 4
+    assert all(bytes(image.asset.data()).startswith(PNG_SIGNATURE) for image in images)
+    assert images[1].offset == images[3].offset
+
+
+def test_load_extracted_rejects_a_truncated_bundle(make_nat, tmp_path):
+    result = extract_file(make_nat(page_count=2), tmp_path / 'out', False, bundle=True)
+    bundle = result.output_path.with_suffix('.natpack')
+    bundle.write_bytes(bundle.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        load_extracted(result.output_path)
+
+
+def test_failed_extraction_removes_the_directory_it_created(make_nat, tmp_path):
+    nat = make_nat('bad.nat')
+    nat.write_bytes(nat.read_bytes()[:40])
+    with pytest.raises(RuntimeError):
+        extract_file(nat, tmp_path / 'out' / 'bad', False)
+    assert not (tmp_path / 'out' / 'bad').exists()
+    existing = tmp_path / 'existing'
+    existing.mkdir()
+    with pytest.raises(RuntimeError):
+        extract_file(nat, existing, False)
+    assert existing.is_dir() and not any(existing.iterdir())
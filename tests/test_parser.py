@@ -0,0 +1,138 @@
+import random
+import struct
+import zlib
+
+import pytest
+
+from conftest import PAGE_BREAK, nat_body, png, text
+from notateit_viewer import parser
+from notateit_viewer.parser import (PNG_SIGNATURE, RECORD_REGEX, TEXT_REGEX, NatDocument, find_png_end,
+                                    iter_decompressed, iter_nat_file, iter_pages, parse_page, split_pages)
+
+
+def describe(page) -> tuple:
+    """Page contents comparable across parses: texts by value, images by their bytes"""
+    return page.page_number, [(obj.type, obj.value if obj.type == 'Text' else bytes(obj.asset.data()))
+                              for obj in page.objects]
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I4s', len(data), chunk_type) + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 8, 9, 64])
+def test_iter_pages_matches_split_pages_whatever_the_chunk_edges(chunk_size):
+    data = b'first page' + PAGE_BREAK + b'second' + PAGE_BREAK + PAGE_BREAK + b'last page'
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    assert [bytes(page) for page in iter_pages(chunks)] == [bytes(page) for page in split_pages(data)]
+
+
+def test_iter_pages_finds_a_break_split_at_every_offset():
+    for split in range(1, len(PAGE_BREAK)):
+        head, tail = b'a' * 20 + PAGE_BREAK[:split], PAGE_BREAK[split:] + b'b' * 20
+        assert [bytes(page) for page in iter_pages([head, tail])] == [b'a' * 20 + PAGE_BREAK, b'b' * 20]
+
+
+def test_pages_straddling_the_inflate_chunk_size(make_nat, monkeypatch):
+    nat = make_nat(page_count=4)
+    expected = [describe(page) for page in iter_nat_file(nat, None)]
+    monkeypatch.setattr(parser, 'CHUNK_SIZE', 37)
+    assert [describe(page) for page in iter_nat_file(nat, None)] == expected
+
+
+@pytest.mark.parametrize('chunk_size', [parser.CHUNK_SIZE, 100])
+def test_iter_decompressed_falls_back_to_raw_deflate(monkeypatch, chunk_size):
+    monkeypatch.setattr(parser, 'CHUNK_SIZE', chunk_size)
+    data = random.Random(1).randbytes(3000) * 3
+    for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+        compressor = zlib.compressobj(wbits=wbits)
+        body = compressor.compress(data) + compressor.flush()
+        assert b''.join(iter_decompressed(memoryview(body))) == data
+
+
+def test_iter_decompressed_reports_a_truncated_stream():
+    body = zlib.compress(random.Random(2).randbytes(5000))
+    with pytest.raises(RuntimeError):
+        b''.join(iter_decompressed(memoryview(body[:len(body) // 2])))
+
+
+def test_find_png_end_walks_chunks():
+    image = png()
+    data = b'ab' + image + b'cd'
+    assert find_png_end(data, 2) == 2 + len(image)
+    for cut in (len(image) - 1, len(image) - 12, 20):
+        assert find_png_end(data[:2 + cut], 2) == -1
+
+
+def test_find_png_end_ignores_iend_bytes_inside_image_data():
+    end_chunk = png_chunk(b'IEND', b'')
+    image = (PNG_SIGNATURE + png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0))
+             + png_chunk(b'IDAT', b'\x00' + end_chunk + b'\x01') + end_chunk)
+    assert find_png_end(image, 0) == len(image)
+
+
+def two_search_records(data: bytes) -> list[tuple[str, int, int]]:
+    """Record scan as it was done before RECORD_REGEX: a text search and a PNG search from the cursor,
+    taking whichever starts first"""
+    records, cursor = [], 0
+    while cursor < len(data):
+        text_match = TEXT_REGEX.search(data, cursor)
+        png_start = data.find(PNG_SIGNATURE, cursor)
+        if text_match is None and png_start == -1:
+            break
+        if text_match is not None and (png_start == -1 or text_match.start() < png_start):
+            records.append(('text', text_match.start(), text_match.end()))
+            cursor = text_match.end()
+        else:
+            png_end = find_png_end(data, png_start)
+            records.append(('png', png_start, png_end))
+            cursor = png_start + len(PNG_SIGNATURE) if png_end == -1 else png_end
+    return records
+
+
+def record_regex_records(data: bytes) -> list[tuple[str, int, int]]:
+    records, cursor = [], 0
+    while cursor < len(data):
+        record = RECORD_REGEX.search(data, cursor)
+        if record is None:
+            break
+        if record.lastgroup == 'text':
+            records.append(('text', record.start(), record.end()))
+            cursor = record.end()
+        else:
+            png_end = find_png_end(data, record.start())
+            records.append(('png', record.start(), png_end))
+            cursor = record.start() + len(PNG_SIGNATURE) if png_end == -1 else png_end
+    return records
+
+
+def noisy_page(seed: int) -> bytes:
+    rng = random.Random(seed)
+    parts = []
+    for _ in range(12):
+        parts.append(rng.choice([text(f'text {rng.random()}'), png(), png()[:30], PNG_SIGNATURE, b'<\0',
+                                 b'\n\n\nabc<\0', rng.randbytes(rng.randrange(1, 40))]))
+    return b''.join(parts)
+
+
+@pytest.mark.parametrize('data', [nat_body(1), nat_body(3)] + [noisy_page(seed) for seed in range(20)])
+def test_record_regex_matches_the_two_search_scan(data):
+    assert record_regex_records(data) == two_search_records(data)
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_parse_page_matches_a_full_parse(make_nat, monkeypatch, compress):
+    if compress:
+        nat = make_nat(page_count=5)
+        monkeypatch.setattr(parser, 'CHUNK_SIZE', 50)
+    else:
+        # stored pictures would be taken for the compressed body, so the uncompressed file holds text only
+        nat = make_nat(body=PAGE_BREAK.join(text(f'Page {n}') + b'\0' + text('Body') for n in range(5)),
+                       compress=False)
+    index = []
+    pages = [describe(page) for page in iter_nat_file(nat, None, index)]
+    document = NatDocument(nat, index)
+    assert document.page_count == len(pages) == 5
+    assert [describe(parse_page(document, number)) for number in range(1, 6)] == pages
+    with pytest.raises(IndexError):
+        parse_page(document, 6)
@@ -0,0 +1,32 @@
+import marshal
+
+from notateit_viewer.cache import ParseCache
+from notateit_viewer.layout import SlideLayout
+from notateit_viewer.parser import iter_nat_file
+from notateit_viewer.renderer import SlideCache
+
+
+def test_layouts_survive_the_parse_cache(make_nat, tmp_path):
+    pages = list(iter_nat_file(make_nat(page_count=3), None))
+    slides = SlideCache(pages, max_layouts=2)
+    layouts = [slides.layout(index) for index in range(3)]
+    assert all(SlideLayout.from_json(layout.to_json()) == layout for layout in layouts)
+
+    cache = ParseCache(tmp_path / 'cache')
+    cache.store_layouts('doc', slides.export_layouts())
+    restored = SlideCache(pages, max_layouts=2)
+    assert restored.restore_layouts(cache.load_layouts('doc'))
+    assert restored.sizes == {index: (layout.width, layout.height) for index, layout in enumerate(layouts)}
+    assert list(restored.layouts) == [1, 2]
+    assert restored.layout(2) == layouts[2]
+
+
+def test_layouts_from_other_settings_are_ignored(make_nat):
+    pages = list(iter_nat_file(make_nat(page_count=1), None))
+    slides = SlideCache(pages)
+    slides.layout(0)
+    _, sizes, layouts = marshal.loads(marshal.dumps(slides.export_layouts()))
+    restored = SlideCache(pages)
+    assert not restored.restore_layouts(('other font', sizes, layouts))
+    assert not restored.restore_layouts(None)
+    assert not restored.sizes and not restored.layouts